@@ -0,0 +1,440 @@
+"""
+Deploy performance benchmarks.
+
+Runs the real deploy tasks against a number of fake hosts, each of which is
+a local directory that stands in for the remote filesystem, using generated
+source repositories and config archives of a configurable size. Reports the
+wall time of each phase, the bytes transferred by rsync and the peak memory
+of each scenario, and appends the results to a JSON file so that
+regressions against the previous run with the same parameters are flagged.
+
+Can be run either as a Fabric task:
+
+    fab -f yellfabric/benchmark.py benchmark:hosts=8,files=2000
+
+or directly:
+
+    python yellfabric/benchmark.py --hosts 8 --files 2000
+"""
+
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import random
+import re
+import resource
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import time
+
+from fabric.api import env, local, puts, abort, hide
+
+import java
+import operations
+import tracing
+import utils
+
+
+SCENARIOS = [
+    "fetch_render_copy",
+    "fetch_render_copy_fan_out",
+    "fetch_render_copy_redeploy",
+    "java_render_stream",
+    "java_render_tree",
+]
+
+TEMPLATE_LINE = "setting.%(n)d = ${bench.value}\n"
+
+
+def generate_text(rand, size, templated):
+    """
+    Generate roughly `size` bytes of config-like text.
+    """
+
+    lines = []
+    length = 0
+    n = 0
+    while length < size:
+        if templated and n % 10 == 0:
+            line = TEMPLATE_LINE % {"n": n}
+        else:
+            line = "key.%d = %x\n" % (n, rand.getrandbits(64))
+        lines.append(line)
+        length += len(line)
+        n += 1
+
+    return "".join(lines)
+
+
+def generate_repo(path, files, file_size, seed=0):
+    """
+    Create a git repository at `path` containing a static project with
+    `files` files of about `file_size` bytes, spread over subdirectories.
+    """
+
+    rand = random.Random(seed)
+    os.makedirs(path)
+
+    with open(os.path.join(path, "index.html.template"), "w") as f:
+        f.write("<title>${bench.value}</title>\n")
+
+    for i in range(files):
+        directory = os.path.join(path, "static", "d%02d" % (i % 50))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(os.path.join(directory, "f%05d.txt" % i), "w") as f:
+            f.write(generate_text(rand, file_size, False))
+
+    with hide("running", "stdout"):
+        with_repo = "cd %s && " % path
+        local(with_repo + "git init --quiet")
+        local(with_repo + "git add -A")
+        local(with_repo + "git -c user.name=bench -c user.email=bench@localhost "
+              "commit --quiet -m 'Benchmark fixture'")
+
+
+def generate_config_archive(path, files, file_size, seed=0):
+    """
+    Create a `*-config.tar.gz` at `path` with `files` templated config files
+    of about `file_size` bytes under `config/`. One in ten is a `.pem` file
+    which isn't templated.
+    """
+
+    rand = random.Random(seed)
+    source = tempfile.mkdtemp()
+
+    try:
+        for i in range(files):
+            directory = os.path.join(source, "config", "d%02d" % (i % 20))
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+
+            if i % 10 == 0:
+                name, templated = "f%05d.pem" % i, False
+            else:
+                name, templated = "f%05d.properties" % i, True
+
+            with open(os.path.join(directory, name), "w") as f:
+                f.write(generate_text(rand, file_size, templated))
+
+        archive = tarfile.open(path, "w:gz")
+        archive.add(os.path.join(source, "config"), "config")
+        archive.close()
+    finally:
+        shutil.rmtree(source)
+
+
+def fake_rsync_command(root, log_file):
+    """
+    Return a replacement for utils.rsync_command() which transfers to the
+    directory `root/<host>` instead of over SSH, logging rsync's statistics
+    to `log_file`.
+    """
+
+    def rsync_command(host_string, local_dir, remote_dir, exclude=(),
+                      delete=False, extra_opts=""):
+        target = os.path.join(root, host_string, remote_dir.lstrip("/"))
+
+        parent = os.path.dirname(target.rstrip("/"))
+        if not os.path.exists(parent):
+            os.makedirs(parent)
+
+        options = ["-pthrz", "--log-file=%s" % log_file]
+        if delete:
+            options.insert(0, "--delete")
+        for pattern in exclude:
+            options.append("--exclude '%s'" % pattern)
+
+        return "rsync %s %s %s" % (" ".join(options), local_dir, target)
+
+    return rsync_command
+
+
+def bytes_sent(log_file):
+    """
+    Total bytes sent according to an rsync log file.
+    """
+
+    if not os.path.exists(log_file):
+        return 0
+
+    total = 0
+    with open(log_file) as f:
+        for line in f:
+            match = re.search(r"sent ([\d,]+) bytes", line)
+            if match:
+                total += int(match.group(1).replace(",", ""))
+
+    return total
+
+
+def run_scenario(scenario, fixtures, workdir, hosts):
+    """
+    Run one scenario in the current process and return its measurements.
+    """
+
+    log_file = os.path.join(workdir, "rsync.log")
+    root = os.path.join(workdir, "hosts")
+
+    utils.rsync_command = fake_rsync_command(root, log_file)
+
+    env.trace_file = os.path.join(workdir, "trace.json")
+    env.hosts = env.all_hosts = ["host%02d" % i for i in range(hosts)]
+    env.scm_type = "git"
+    env.scm_url = "file://%s" % fixtures["repo"]
+    env.config_source = "index.html.template"
+    env.config_target = "index.html"
+    env.settings_vars = ["bench.value"]
+    env["bench.value"] = "benchmark"
+    env.template_key = "$"
+    env.project_name = "bench"
+    env.project_path = "/srv/www/bench"
+    env.sudo_user = None
+    env.non_template_exts = [".pem"]
+    env.app_config_archive = fixtures["config_archive"]
+
+    start = time.time()
+    first_span = 0
+
+    if scenario.startswith("fetch_render_copy"):
+        env.fan_out = scenario == "fetch_render_copy_fan_out"
+        deploys = 2 if scenario == "fetch_render_copy_redeploy" else 1
+
+        for deploy in range(deploys):
+            # Only the last deploy of a redeploy is measured.
+            if deploy == deploys - 1:
+                if os.path.exists(log_file):
+                    os.remove(log_file)
+                start = time.time()
+                first_span = len(tracing.recorded_spans())
+
+            for host in env.hosts:
+                env.host_string = env.host = host
+                operations.fetch_render_copy("master", copy_remote=True)
+
+            # Allow the next deploy to fetch and push again.
+            for func in (utils.fetch_source, utils.scm_get_info,
+                         utils.template_context,
+                         operations._fetch_render_fan_out,
+                         operations.rsync_to_hosts):
+                if hasattr(func, "return_value"):
+                    del func.return_value
+
+    elif scenario == "java_render_stream":
+        env.rendered_config_dir = None
+        java.render_settings_template()
+
+    elif scenario == "java_render_tree":
+        env.rendered_config_dir = os.path.join(workdir, "rendered")
+        java.render_settings_template()
+
+    wall = time.time() - start
+
+    phases = {}
+    for name, (count, total, longest) in \
+            tracing.phase_totals(tracing.recorded_spans()[first_span:]).iteritems():
+        phases[name] = round(total, 3)
+
+    return {
+        "wall": round(wall, 3),
+        "phases": phases,
+        "bytes": bytes_sent(log_file),
+        "peak_rss_kb": max(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss),
+    }
+
+
+def _run_in_child(scenario, fixtures, workdir, hosts, queue):
+    try:
+        with hide("running", "stdout"):
+            queue.put(run_scenario(scenario, fixtures, workdir, hosts))
+    except BaseException as e:
+        queue.put({"error": "%s: %s" % (e.__class__.__name__, e)})
+
+
+def measure(scenario, fixtures, hosts):
+    """
+    Run a scenario in a fresh process, so that peak memory and Fabric's
+    runs_once state are its own, and return its measurements.
+    """
+
+    workdir = tempfile.mkdtemp(prefix="yellfabric-bench-")
+    queue = multiprocessing.Queue()
+
+    try:
+        child = multiprocessing.Process(
+            target=_run_in_child,
+            args=(scenario, fixtures, workdir, hosts, queue))
+        child.start()
+        result = queue.get()
+        child.join()
+    finally:
+        shutil.rmtree(workdir)
+
+    return result
+
+
+def version():
+    """
+    The version of yellfabric being benchmarked, from git if possible.
+    """
+
+    try:
+        return subprocess.check_output(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def previous_run(history, params):
+    for run in reversed(history):
+        if run["params"] == params:
+            return run
+
+    return None
+
+
+def report(run, previous, threshold, min_delta):
+    """
+    Print the results of a run and return the names of the scenarios whose
+    wall time regressed by more than `threshold` against `previous`. Slowdowns
+    of no more than `min_delta` seconds are noise, however large a fraction
+    of a short scenario they are.
+    """
+
+    regressions = []
+
+    puts("%-28s %9s %9s %12s %12s" % (
+        "scenario", "wall (s)", "previous", "bytes sent", "peak RSS kB"),
+        show_prefix=False)
+
+    for scenario in SCENARIOS:
+        result = run["results"].get(scenario)
+        if result is None:
+            continue
+
+        if "error" in result:
+            puts("%-28s failed: %s" % (scenario, result["error"]),
+                 show_prefix=False)
+            continue
+
+        before = None
+        if previous and "wall" in previous["results"].get(scenario, {}):
+            before = previous["results"][scenario]["wall"]
+
+        flag = ""
+        if before and result["wall"] > before * (1 + threshold) and \
+                result["wall"] - before > min_delta:
+            flag = "  REGRESSION"
+            regressions.append(scenario)
+
+        puts("%-28s %9.2f %9s %12d %12d%s" % (
+            scenario, result["wall"],
+            "%.2f" % before if before else "-",
+            result["bytes"], result["peak_rss_kb"], flag),
+            show_prefix=False)
+
+        for name, total in sorted(result["phases"].iteritems(),
+                                  key=lambda item: -item[1]):
+            puts("    %-24s %9.2f" % (name, total), show_prefix=False)
+
+    return regressions
+
+
+def benchmark(hosts=4, files=1000, file_size=2048, config_files=1000,
+              results="benchmark-results.json", threshold=0.1,
+              scenarios=None, min_delta=0.5):
+    """
+    Run the benchmark scenarios and record the results.
+
+        - hosts: Number of fake hosts to deploy to.
+        - files: Number of files in the generated source repository.
+        - file_size: Approximate size in bytes of each generated file.
+        - config_files: Number of files in the generated config archive.
+        - results: JSON file that results are appended to.
+        - threshold: Fractional slowdown in wall time, compared to the last
+          run with the same parameters, that is flagged as a regression.
+        - scenarios: Comma separated subset of scenarios to run.
+        - min_delta: Slowdown in seconds that a scenario must also exceed to
+          be flagged, so that noise in short scenarios isn't.
+    """
+
+    params = {
+        "hosts": int(hosts),
+        "files": int(files),
+        "file_size": int(file_size),
+        "config_files": int(config_files),
+    }
+
+    if scenarios:
+        scenarios = scenarios.split(",")
+        for scenario in scenarios:
+            if scenario not in SCENARIOS:
+                abort("Unknown scenario %r" % scenario)
+    else:
+        scenarios = SCENARIOS
+
+    fixture_dir = tempfile.mkdtemp(prefix="yellfabric-fixtures-")
+    try:
+        fixtures = {
+            "repo": os.path.join(fixture_dir, "repo"),
+            "config_archive": os.path.join(fixture_dir, "bench-config.tar.gz"),
+        }
+        generate_repo(fixtures["repo"], params["files"], params["file_size"])
+        generate_config_archive(fixtures["config_archive"],
+                                params["config_files"], params["file_size"])
+
+        run = {
+            "version": version(),
+            "time": datetime.datetime.utcnow().isoformat(),
+            "params": params,
+            "results": {},
+        }
+        for scenario in scenarios:
+            run["results"][scenario] = measure(scenario, fixtures,
+                                               params["hosts"])
+    finally:
+        shutil.rmtree(fixture_dir)
+
+    history = []
+    if os.path.exists(results):
+        with open(results) as f:
+            history = json.load(f)
+
+    regressions = report(run, previous_run(history, params), float(threshold),
+                         float(min_delta))
+
+    history.append(run)
+    with open(results, "w") as f:
+        json.dump(history, f, indent=2)
+
+    if regressions:
+        abort("Regressions in: %s" % ", ".join(regressions))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--hosts", type=int, default=4)
+    parser.add_argument("--files", type=int, default=1000)
+    parser.add_argument("--file-size", type=int, default=2048)
+    parser.add_argument("--config-files", type=int, default=1000)
+    parser.add_argument("--results", default="benchmark-results.json")
+    parser.add_argument("--threshold", type=float, default=0.1)
+    parser.add_argument("--scenarios", default=None,
+                        help="Comma separated subset of: %s" % ", ".join(SCENARIOS))
+    parser.add_argument("--min-delta", type=float, default=0.5)
+    args = parser.parse_args()
+
+    benchmark(args.hosts, args.files, args.file_size, args.config_files,
+              args.results, args.threshold, args.scenarios, args.min_delta)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+import fcntl
 import os
 from fabric.api import prefix
 from contextlib import contextmanager
@@ -44,3 +45,23 @@ def virtualenv(virtualenv=None):
         return prefix(cmd)
 
     return _DummyContext()
+
+
+@contextmanager
+def cache_lock(cache_dir=None):
+    """
+    Context wrapper holding an exclusive lock on a local cache directory, so
+    that concurrent fab runs don't update or prune it at the same time.
+    """
+
+    if not cache_dir:
+        yield
+        return
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    # Beside the cache rather than in it, where it would be pruned.
+    with open("%s.lock" % cache_dir.rstrip("/"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
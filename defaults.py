@@ -23,3 +23,35 @@ env.shell = "/bin/bash -c"
 env.sudo_user = None
 env.http_proxy = None
 env.https_proxy = None
+
+# Local cache of SCM mirrors used by fetch_source(). Disabled when None.
+env.scm_cache = None
+env.scm_cache_max_size = 4096
+
+# Local cache of build_local_cmd outputs used by fetch_render_copy(). Disabled
+# when None.
+env.build_cache = None
+env.build_cache_max_size = 4096
+
+# Directory for the SSH control sockets shared by rsync. Disabled when None.
+env.ssh_control_dir = None
+env.ssh_control_persist = 600
+
+# Directory for compiled extdata stores used by load_extdata(). Disabled when
+# None.
+env.extdata_cache = None
+
+# Number of release directories kept on each host when env.releases is set.
+env.keep_releases = 5
+
+# Directory for the checkpoint journals used by resume(). Disabled when None.
+env.deploy_journal = None
+
+# Play 2 blue/green deploys, used when env.play2_blue_green is set.
+env.play2_blue_green_ports = {"blue": 9001, "green": 9002}
+env.play2_upstream_template = \
+    "upstream %(project_name)s {\n    server 127.0.0.1:%(port)d;\n}\n"
+env.play2_proxy_reload = "service nginx reload"
+env.play2_ready_path = "/"
+env.play2_ready_timeout = 120
+env.play2_drain_time = 5
@@ -0,0 +1,160 @@
+"""
+Compiled store of Puppet extlookup/extdata CSV files.
+"""
+
+import cPickle as pickle
+import collections
+import hashlib
+import csv
+import os
+
+from fabric.api import env, abort, puts
+
+from utils import file_checksum
+
+
+class ExtdataStore(collections.MutableMapping):
+    """
+    Lookup store built from a hierarchy of extdata CSV files. It behaves like
+    the dictionary of `{key: values}` that it replaces.
+
+    Files are given in order of precedence, so a key in an earlier file
+    shadows the same key in later ones. Filenames may contain `%(name)s`
+    placeholders which are filled from Fabric's env when the store is first
+    used, e.g. `secrets-%(environment)s.csv`. Files with placeholders are
+    optional, while plain filenames must exist.
+
+    Nothing is read until the first lookup. If env.extdata_cache is set the
+    parsed rows are also kept there and only rebuilt when the size, mtime
+    and then the content hash of one of the files has changed.
+    """
+
+    def __init__(self, filenames):
+        self.filenames = list(filenames)
+        self._data = None
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+
+    def __delitem__(self, key):
+        del self.data[key]
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def copy(self):
+        return dict(self.data)
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = self.load()
+        return self._data
+
+    def paths(self):
+        """
+        The files of the hierarchy which are in use, in order of precedence.
+        """
+
+        paths = []
+        for filename in self.filenames:
+            optional = "%(" in filename
+            if optional:
+                filename = filename % env
+
+            path = os.path.abspath(os.path.expanduser(filename))
+
+            if os.path.exists(path):
+                paths.append(path)
+            elif not optional:
+                abort("File %r not found" % path)
+
+        return paths
+
+    def load(self):
+        paths = self.paths()
+        sources = [(path, os.path.getmtime(path), os.path.getsize(path))
+                   for path in paths]
+
+        cache = self.cache_path(paths)
+        compiled = self.read_cache(cache)
+
+        if compiled and compiled["sources"] == sources:
+            return compiled["data"]
+
+        hashes = [file_checksum(path) for path in paths]
+
+        if compiled and compiled["hashes"] == hashes:
+            # Only the mtimes changed, e.g. from a fresh checkout.
+            data = compiled["data"]
+        else:
+            data = self.parse(paths)
+            puts("Compiled extdata from %s" % ", ".join(self.filenames))
+
+        self.write_cache(cache, {"sources": sources, "hashes": hashes,
+                                 "data": data})
+
+        return data
+
+    def parse(self, paths):
+        data = {}
+
+        # Walk from lowest to highest precedence so that earlier files win.
+        for path in reversed(paths):
+            with open(path) as f:
+                for row in csv.reader(f):
+                    if len(row) < 1:
+                        continue
+
+                    data[row[0]] = row[1:]
+
+        return data
+
+    def cache_path(self, paths):
+        if not env.get("extdata_cache"):
+            return None
+
+        key = hashlib.sha1("\0".join(paths)).hexdigest()
+        return os.path.join(os.path.expanduser(env.extdata_cache),
+                            "%s.pickle" % key)
+
+    def read_cache(self, cache):
+        if not cache or not os.path.exists(cache):
+            return None
+
+        # A truncated or stale pickle can fail in many ways, and is rebuilt.
+        try:
+            with open(cache, "rb") as f:
+                compiled = pickle.load(f)
+        except Exception:
+            return None
+
+        if not isinstance(compiled, dict) or \
+                not set(["sources", "hashes", "data"]).issubset(compiled):
+            return None
+
+        return compiled
+
+    def write_cache(self, cache, compiled):
+        if not cache:
+            return
+
+        # The store contains secrets, so keep it private.
+        directory = os.path.dirname(cache)
+        if not os.path.exists(directory):
+            os.makedirs(directory, 0700)
+
+        partial = "%s.partial" % cache
+        fd = os.open(partial, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(compiled, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(partial, cache)
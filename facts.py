@@ -0,0 +1,257 @@
+"""
+Facts about the hosts being deployed to.
+
+The facts of every host of the run are gathered concurrently the first
+time they are needed, with a single remote command per host, and kept for
+the rest of the run. They are:
+
+    - version: The `version` file in env.project_path, as written by
+      utils.fetch_source().
+    - deployed: The version recorded by mark_deployed() at the end of the
+      last deploy that completed on the host.
+    - disk_free: Kilobytes available on the filesystem of env.project_path.
+    - supervisor: `{program: state}` from `supervisorctl status`.
+    - virtualenv_fingerprint: The fingerprint recorded in the virtualenv by
+      python.pip_requirements().
+
+Missing files and commands are reported as None or empty, and hosts whose
+facts couldn't be gathered have none at all, so they are never skipped.
+"""
+
+import json
+import os
+import pipes
+import re
+import sys
+
+import python
+import rolling
+import tracing
+import utils
+
+from fabric.api import env, execute, parallel, runs_once, sudo, local, puts, hide, settings
+
+
+SEPARATOR = "--yellfabric-facts--"
+
+
+def deployed_path():
+    """
+    Path of the file in which mark_deployed() records the deployed version.
+    It sits beside env.project_path so that transfers never touch it.
+    """
+
+    return "%s.deployed" % env.project_path.rstrip("/")
+
+
+def _collect():
+    """
+    Read the raw facts of the current host in one round trip.
+    """
+
+    paths = {
+        "project": env.project_path.rstrip("/"),
+        "deployed": deployed_path(),
+        "parent": os.path.dirname(env.project_path.rstrip("/")),
+        "fingerprint": "/dev/null",
+        "separator": SEPARATOR,
+    }
+
+    if env.get("virtualenv_path"):
+        paths["fingerprint"] = python.virtualenv_fingerprint_path()
+
+    # supervisorctl is run as root, like utils.supervisorctl().
+    script = ("cat %(project)s/version; echo; echo %(separator)s; "
+              "cat %(deployed)s; echo; echo %(separator)s; "
+              "df -Pk %(parent)s | tail -n 1; echo %(separator)s; "
+              "supervisorctl status; echo %(separator)s; "
+              "cat %(fingerprint)s; true") % paths
+
+    with settings(hide("running", "stdout", "stderr", "warnings"),
+                  warn_only=True):
+        return sudo("(%s) 2>/dev/null" % script)
+
+
+def parse(output):
+    """
+    Turn the output of _collect() into a dictionary of facts.
+    """
+
+    sections = [s.strip() for s in output.replace("\r", "").split(SEPARATOR)]
+    sections += [""] * (5 - len(sections))
+    version, deployed, df, supervisor, fingerprint = sections[:5]
+
+    def load_version(text):
+        try:
+            return json.loads(text)
+        except ValueError:
+            return None
+
+    disk_free = None
+    fields = df.split()
+    if len(fields) >= 4 and fields[3].isdigit():
+        disk_free = int(fields[3])
+
+    programs = {}
+    for line in supervisor.splitlines():
+        fields = line.split()
+        if len(fields) >= 2:
+            programs[fields[0]] = fields[1]
+
+    return {
+        "version": load_version(version),
+        "deployed": load_version(deployed),
+        "disk_free": disk_free,
+        "supervisor": programs,
+        "virtualenv_fingerprint": fingerprint or None,
+    }
+
+
+@runs_once
+@tracing.phase("facts")
+def gather():
+    """
+    Gather the facts of every host of the run, at most
+    env.fan_out_pool_size at a time, and return `{host_string: facts}`.
+    """
+
+    collect = parallel(pool_size=env.get("fan_out_pool_size", 10))(_collect)
+
+    # Otherwise one unreachable host aborts the whole run.
+    with settings(warn_only=True, skip_bad_hosts=True):
+        results = execute(collect, hosts=utils.all_hosts())
+
+    # A host whose command failed has None or an exception instead.
+    failed = sorted([host for host, output in results.items()
+                     if not isinstance(output, basestring)])
+    if failed:
+        puts("Couldn't gather the facts of %s" % ", ".join(failed))
+
+    return dict([(host, parse(output)) for host, output in results.items()
+                 if host not in failed])
+
+
+def host_facts(host_string=None):
+    """
+    The facts of a host, by default the current one.
+    """
+
+    return gather().get(host_string or env.host_string, {})
+
+
+def target_version(ref=None, dirty=False):
+    """
+    The version that this run deploys, from utils.scm_get_info(). Fetches
+    the source if that hasn't already happened.
+    """
+
+    utils.fetch_source(env.scm_type, env.scm_url, ref, dirty)
+    return utils.scm_get_info(env.scm_type)
+
+
+@runs_once
+def target_commit(ref=None):
+    """
+    The Git commit that `ref` points at in env.scm_url, found with
+    `git ls-remote` so that nothing has to be fetched. None for other SCMs,
+    and for refs that can't be resolved unambiguously that way.
+    """
+
+    if env.scm_type.lower() != "git":
+        return None
+
+    ref = ref or utils.scm_get_ref(env.scm_type)
+    if re.match(r"^[0-9a-f]{40}$", ref):
+        return ref
+
+    with settings(hide("running", "stdout", "warnings"), warn_only=True):
+        out = local("git ls-remote %s %s %s" % (
+            pipes.quote(env.scm_url), pipes.quote(ref),
+            pipes.quote("%s^{}" % ref)), capture=True)
+
+    refs = dict([line.split()[::-1] for line in out.splitlines()
+                 if len(line.split()) == 2])
+    names = [name for name in refs
+             if name in ("refs/heads/%s" % ref, "refs/tags/%s" % ref)]
+
+    if out.failed or len(names) != 1:
+        return None
+
+    # Annotated tags are followed to their commit.
+    return refs.get("%s^{}" % names[0], refs[names[0]])
+
+
+def is_current(host_string, ref=None, dirty=False):
+    """
+    Whether the last completed deploy to a host was of the target revision.
+    Local changes are never considered to be deployed. When the commit of
+    `ref` can be resolved remotely, hosts are compared without fetching the
+    source.
+    """
+
+    if dirty:
+        return False
+
+    deployed = host_facts(host_string).get("deployed") or {}
+
+    commit = deployed.get("commit") and target_commit(ref)
+    if commit:
+        return deployed["commit"] == commit
+
+    target = target_version(ref, dirty)
+
+    return bool(deployed.get("rev")) and deployed.get("rev") == target["rev"]
+
+
+def current_hosts(ref=None, dirty=False):
+    """
+    The hosts that env.skip_current_hosts would skip.
+    """
+
+    if not env.get("skip_current_hosts"):
+        return []
+
+    return [h for h in utils.all_hosts() if is_current(h, ref, dirty)]
+
+
+def skip_current_host(ref=None, dirty=False):
+    """
+    Return True if the current host should be skipped because it is already
+    at the target revision and env.skip_current_hosts is set.
+
+    Otherwise the host's deployed marker is removed, so that it isn't
+    skipped by a retry if this deploy fails before mark_deployed().
+    """
+
+    if not env.get("skip_current_hosts"):
+        return False
+
+    if is_current(env.host_string, ref, dirty):
+        puts("Already at %s, skipping" % host_facts()["deployed"]["rev"])
+        rolling.skip()
+
+        # The last host removes the checkout, if another host needed one.
+        tempdir = getattr(utils.fetch_source, "return_value", None)
+        if tempdir and os.path.isdir(tempdir):
+            utils.delete_source_conditional(tempdir, dirty)
+
+        return True
+
+    sudo("rm -f %s" % deployed_path(), user=env.sudo_user)
+    return False
+
+
+def mark_deployed(ref=None, dirty=False):
+    """
+    Record the target version as deployed to the current host.
+    """
+
+    if not env.get("skip_current_hosts") or dirty:
+        return
+
+    sudo("echo %s > %s" % (
+        pipes.quote(json.dumps(target_version(ref, dirty))),
+        deployed_path()), user=env.sudo_user)
+
+
+tracing.instrument(sys.modules[__name__])
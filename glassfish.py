@@ -1,13 +1,17 @@
 import glob
 import os.path
+import re
 import shutil
 import sys
+import tarfile
 import tempfile
 
-from fabric.api import local, env, sudo, lcd, run, runs_once, require, hide
-from fabric.contrib.project import rsync_project
+from fabric.api import env, sudo, lcd, run, put, runs_once, require, hide, settings, abort
+from cStringIO import StringIO
+from xml.dom import minidom
 
-from utils import template_context, template_to_file
+import tracing
+from utils import rsync_project, template_context, render_archive, deploy_archive
 from fabric.operations import prompt
 
 @runs_once
@@ -19,30 +23,18 @@ def setup_paths():
     env.app_config_archive = "%s-config.tar.gz" % env.project_name
     env.app_config_dir = os.path.join(env.java_conf, env.config_dir_name)
     env.log_dir = os.path.join(env.java_log, env.project_name)
-    env.asadmin = "/opt/glassfish/bin/asadmin --terse"
+    env.asadmin_bin = "/opt/glassfish/bin/asadmin"
+    env.asadmin = "%s --terse" % env.asadmin_bin
 
 @runs_once
+@tracing.phase("render")
 def render_settings_template():
-    tempdir = tempfile.mkdtemp()
-    local("tar -C'%s' -xzf '%s'" % (tempdir, env.app_config_archive))
-
-    source_dir = os.path.join(tempdir, 'config')
-    target_dir = os.path.join(tempdir, 'processed-config')
-
-    os.mkdir(target_dir)
     context = template_context(env.settings_vars)
 
-    for conf_file in os.listdir(source_dir):
-        template_to_file(os.path.join(source_dir, conf_file),
-                         os.path.join(target_dir, conf_file),
-                         context)
-
-    # Need to copy target_dir/etc and it's subdirectories to /etc/ for
-    # the application configuration
-    #shutil.copytree(os.path.join(target_dir, "etc"), "/etc")
-
-    env.deploy_config_dir = target_dir
+    env.deploy_config_archive = render_archive(
+        env.app_config_archive, "config", context)
 
+@tracing.phase("transfer")
 def rsync_as_user(remote_dir, local_dir, user, delete = False, exclude = ()):
     extra_opts = '--rsync-path="sudo -u %s rsync"' % user
     rsync_project(remote_dir, local_dir, exclude = exclude, delete = delete, extra_opts = extra_opts)
@@ -112,8 +104,8 @@ def deploy_java():
     render_settings_template()
 
     require("sudo_user")
-    require("app_config_dir", "deploy_config_dir")
-    rsync_as_user("%s/" % env.app_config_dir, "%s/" % env.deploy_config_dir, env.sudo_user, delete = True)
+    require("app_config_dir", "deploy_config_archive")
+    deploy_archive(env.deploy_config_archive, env.app_config_dir, env.sudo_user, delete = True)
 
     require("war_file", "war_path")
     rsync_as_user(env.war_path, env.war_file, env.sudo_user)
@@ -121,6 +113,10 @@ def deploy_java():
     require("java_root", "project_name")
     remote_war_file=os.path.join(env.java_root, "%s.war" % env.project_name)
 
+    if env.get("asadmin_multimode", True):
+        deploy_batch(remote_war_file)
+        return
+
     undeploy(env.project_name)
 
     if env.jdbc_cp_jndi_name:
@@ -135,3 +131,184 @@ def deploy_java():
         deploy_resources(resource_file)
 
     deploy(env.project_name, remote_war_file)
+
+def deploy_batch(war):
+    """
+    Perform the same steps as deploy_java() in a single asadmin session
+
+    Removing an application or resource that doesn't exist fails harmlessly,
+    so those steps are run unconditionally instead of listing first.
+    """
+
+    require("java_conf", "project_name")
+
+    # (command, whether failure should abort the deploy)
+    commands = [("undeploy %s" % env.project_name, False)]
+
+    resource_file = None
+    if env.get("glassfish_reconcile_resources"):
+        resource_file = run("mktemp")
+        commands.extend(reconcile_resources(resource_file))
+    else:
+        if env.jdbc_cp_jndi_name:
+            commands.append(("delete-jdbc-connection-pool --cascade true %s" % env.jdbc_cp_jndi_name, False))
+
+        if env.mail_resource_jndi_name:
+            commands.append(("delete-javamail-resource %s" % env.mail_resource_jndi_name, False))
+
+        if env.resources_to_deploy:
+            resource_file=os.path.join(env.java_conf, env.config_dir_name, "glassfish-resources.xml")
+            commands.append(("add-resources %s" % resource_file, True))
+
+    commands.append(("deploy %s" % war, True))
+
+    try:
+        results = asadmin_multimode([command for command, required in commands])
+    finally:
+        if env.get("glassfish_reconcile_resources"):
+            run("rm -f %s" % resource_file)
+
+    for (command, required), (succeeded, output) in zip(commands, results):
+        if required and not succeeded:
+            abort("asadmin %s failed:\n%s" % (command, output))
+
+def reconcile_resources(resource_file):
+    """
+    Compare the rendered glassfish-resources.xml with the domain's current
+    resources and return the asadmin commands that are needed to bring the
+    domain in line, instead of deleting and recreating everything.
+
+    New resources are written to `resource_file` on the remote host for
+    add-resources, changed attributes and properties are updated in place
+    with `set`, and env.jdbc_cp_jndi_name or env.mail_resource_jndi_name are
+    deleted if they are no longer defined. Attributes that have been removed
+    from the XML are not reset to their defaults.
+    """
+
+    require("deploy_config_archive")
+
+    if env.resources_to_deploy:
+        dom = read_resources_xml(env.deploy_config_archive)
+    else:
+        dom = minidom.parseString("<resources/>")
+
+    with hide("stdout"):
+        current = run('%s get "resources.*"' % env.asadmin).splitlines()
+    current = dict(line.strip().split("=", 1) for line in current if "=" in line)
+
+    commands = []
+    defined = set()
+
+    for element in [x for x in dom.documentElement.childNodes if x.nodeType == x.ELEMENT_NODE]:
+        resource_id = element.getAttribute("name") or element.getAttribute("jndi-name")
+        defined.add(resource_id)
+
+        prefix = "resources.%s.%s." % (element.tagName, resource_id)
+        if not [key for key in current if key.startswith(prefix)]:
+            # Leave it in the document for add-resources.
+            continue
+
+        # Dots within the resource's name must be escaped for `set`.
+        set_prefix = "resources.%s.%s." % (element.tagName, resource_id.replace(".", "\\."))
+
+        desired = resource_attributes(element)
+        for key, value in sorted(desired.iteritems()):
+            if current.get(prefix + key) != value:
+                commands.append(('set "%s%s=%s"' % (set_prefix, key, value), True))
+
+        # An empty value removes a property.
+        for key in sorted(current):
+            if key.startswith(prefix + "property.") and key[len(prefix):] not in desired:
+                commands.append(('set "%s%s="' % (set_prefix, key[len(prefix):]), True))
+
+        dom.documentElement.removeChild(element)
+
+    if env.jdbc_cp_jndi_name and env.jdbc_cp_jndi_name not in defined:
+        commands.insert(0, ("delete-jdbc-connection-pool --cascade true %s" % env.jdbc_cp_jndi_name, False))
+
+    if env.mail_resource_jndi_name and env.mail_resource_jndi_name not in defined:
+        commands.insert(0, ("delete-javamail-resource %s" % env.mail_resource_jndi_name, False))
+
+    # Anything left in the document is new.
+    if [x for x in dom.documentElement.childNodes if x.nodeType == x.ELEMENT_NODE]:
+        put(StringIO(dom.toxml("utf-8")), resource_file)
+        commands.append(("add-resources %s" % resource_file, True))
+
+    return commands
+
+def read_resources_xml(archive):
+    """
+    Parse glassfish-resources.xml from the rendered config archive
+    """
+
+    config = tarfile.open(archive, "r:gz")
+    try:
+        return minidom.parse(config.extractfile("glassfish-resources.xml"))
+    finally:
+        config.close()
+
+def resource_attributes(element):
+    """
+    Flatten a resource element from glassfish-resources.xml into the same
+    dotted keys that `asadmin get` uses, relative to the resource itself
+    """
+
+    attributes = dict(element.attributes.items())
+
+    for child in element.getElementsByTagName("property"):
+        attributes["property.%s" % child.getAttribute("name")] = child.getAttribute("value")
+
+    return attributes
+
+@tracing.phase("asadmin")
+def asadmin_multimode(commands):
+    """
+    Run a list of asadmin commands in one `asadmin multimode` session, so
+    that only one JVM is started, and return a list of (succeeded, output)
+    tuples in the same order
+    """
+
+    require("asadmin_bin")
+
+    script = run("mktemp")
+    try:
+        put(StringIO("\n".join(commands) + "\n"), script)
+        with settings(warn_only = True):
+            out = run("%s multimode --file %s" % (env.asadmin_bin, script))
+    finally:
+        run("rm -f %s" % script)
+
+    results = parse_multimode(out, commands)
+
+    if len(results) != len(commands):
+        abort("Expected %d results from asadmin multimode, got %d:\n%s" % (len(commands), len(results), out))
+
+    return results
+
+def parse_multimode(output, commands):
+    """
+    Split the output of `asadmin multimode` into (succeeded, output) tuples,
+    using the status line that asadmin prints after each of `commands`, in
+    order. Anything after the last of them, such as the status line of
+    multimode itself, is ignored
+    """
+
+    names = [command.split()[0] for command in commands]
+    results = []
+    lines = []
+
+    for line in output.splitlines():
+        if len(results) == len(names):
+            break
+
+        match = re.match(r"Command (\S+) (executed successfully|failed)", line.strip())
+        if match and match.group(1) == names[len(results)]:
+            results.append((match.group(2) != "failed", "\n".join(lines)))
+            lines = []
+        else:
+            lines.append(line)
+
+    return results
+
+
+tracing.instrument(sys.modules[__name__])
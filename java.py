@@ -1,13 +1,17 @@
+import atexit
 import glob
 import os.path
 import sys
 import shutil
 import tempfile
 
-from fabric.api import local, env, sudo, runs_once, require
-from fabric.contrib.project import rsync_project
+from fabric.api import local, env, sudo, runs_once, require, puts
 
-from utils import template_context, template_to_file
+import journal
+import pipeline
+import rolling
+import tracing
+from utils import rsync_project, template_context, render_tree, render_archive, deploy_archive
 
 
 @runs_once
@@ -19,6 +23,7 @@ def setup_paths():
 
     env.war_file = "%s.war" % env.project_name
     env.war_path = os.path.join(env.java_root, env.war_file)
+    env.war_exploded_path = os.path.join(env.java_root, "%s.exploded" % env.project_name)
 
     env.app_config_archive = "%s-config.tar.gz" % env.project_name
     env.sql_archive = "%s-sql.tar.gz" % env.project_name
@@ -40,6 +45,7 @@ def setup_paths():
 
 
 @runs_once
+@tracing.phase("render")
 def render_settings_template():
     try:
         env.non_template_exts
@@ -48,38 +54,57 @@ def render_settings_template():
     except AttributeError:
        env.non_template_exts = []
 
+    context = template_context(env.settings_vars)
+
+    # A persistent target allows unchanged files to be skipped both when
+    # rendering and by rsync. Otherwise the archive is rendered as a stream
+    # and unpacked on the remote side.
+    if not env.get("rendered_config_dir"):
+        env.deploy_config_archive = render_archive(
+            env.app_config_archive, "config", context, env.non_template_exts)
+        return
+
     tempdir = tempfile.mkdtemp()
     local("tar -C'%s' -xzf '%s'" % (tempdir, env.app_config_archive))
 
     source_dir = os.path.join(tempdir, 'config')
-    target_dir = os.path.join(tempdir, 'processed-config')
+    target_dir = os.path.join(
+        os.path.expanduser(env.rendered_config_dir), env.project_name)
 
-    os.mkdir(target_dir)
-    context = template_context(env.settings_vars)
+    written = render_tree(source_dir, target_dir, context,
+                          env.non_template_exts,
+                          env.get("render_pool_size", 8))
+    puts("Rendered %d changed config file(s)" % written)
 
-    for root, dirs, files in os.walk(source_dir):
-        relative_path = os.path.relpath(root, source_dir)
+    shutil.rmtree(tempdir)
 
-        for conf_dir in dirs:
-            conf_dir = os.path.join(target_dir, relative_path, conf_dir)
-            if not os.path.exists(conf_dir):
-                os.makedirs(conf_dir)
+    env.deploy_config_dir = target_dir
 
-        for conf_file in files:
-            conf_file = os.path.join(relative_path, conf_file)
-            file_extension = os.path.splitext(conf_file)[1]
 
-            if file_extension in env.non_template_exts:
-                shutil.copy(os.path.join(source_dir, conf_file),
-                             os.path.join(target_dir, conf_file))
-            else:
-                template_to_file(os.path.join(source_dir, conf_file),
-                             os.path.join(target_dir, conf_file),
-                             context)
-
-    env.deploy_config_dir = target_dir
+@journal.checkpoint("config")
+@tracing.phase("transfer")
+def sync_config(remote_dir):
+    """
+    Push the output of render_settings_template() to `remote_dir`.
+    """
 
+    require("sudo_user")
 
+    if env.get("deploy_config_archive"):
+        deploy_archive(env.deploy_config_archive, remote_dir, env.sudo_user,
+                       delete=True)
+    else:
+        require("deploy_config_dir")
+        rsync_as_user(
+            "%s/" % remote_dir,
+            "%s/" % env.deploy_config_dir,
+            env.sudo_user,
+            delete=True,
+        )
+
+
+@journal.checkpoint("transfer")
+@tracing.phase("transfer")
 def rsync_as_user(remote_dir, local_dir, user, delete=False, exclude=()):
     extra_opts = '--rsync-path="sudo -u %s rsync"' % user
     rsync_project(
@@ -91,28 +116,39 @@ def rsync_as_user(remote_dir, local_dir, user, delete=False, exclude=()):
     )
 
 
+@journal.resumable
 def deploy_java():
-    render_settings_template()
-
     require("sudo_user")
-    require("app_config_dir", "deploy_config_dir")
-    rsync_as_user(
-        "%s/" % env.app_config_dir,
-        "%s/" % env.deploy_config_dir,
-        env.sudo_user,
-        delete=True,
-    )
+    require("app_config_dir")
+    require("app_xml_config_dir")
+    require("war_file", "war_path")
+    require("tomcat_deploy_webapp", "project_name")
 
-    require("app_xml_config_dir", "deploy_config_dir")
-    rsync_as_user(
-        "%s/" % env.app_xml_config_dir,
-        "%s/" % env.deploy_config_dir,
-        env.sudo_user,
-        delete=True
-    )
+    # The WAR is pushed while the config is rendered, and both config
+    # directories at once, when env.concurrent_pipelines is set.
+    deploy = pipeline.Pipeline("deploy_java")
+    deploy.add("render", render_settings_template)
+    deploy.add("app_config", lambda: sync_config(env.app_config_dir),
+               requires=["render"], remote=True)
+    deploy.add("xml_config", lambda: sync_config(env.app_xml_config_dir),
+               requires=["render"], remote=True)
+
+    if env.get("war_exploded"):
+        deploy.add("explode", explode_war)
+        deploy.add("war", sync_exploded_war, requires=["explode"], remote=True)
+    else:
+        deploy.add("war", lambda: rsync_as_user(env.war_path, env.war_file,
+                                                env.sudo_user), remote=True)
+
+    deploy.add("deploy", deploy_tomcat_webapp,
+               requires=["app_config", "xml_config", "war"], remote=True)
+    deploy.run()
 
-    require("war_file", "war_path")
-    rsync_as_user(env.war_path, env.war_file, env.sudo_user)
+
+def deploy_tomcat_webapp():
+    """
+    Deploy the WAR at env.war_path to Tomcat.
+    """
 
     require("tomcat_deploy_webapp", "project_name")
     cmd = "%s %s" % (env.tomcat_deploy_webapp, env.project_name)
@@ -123,6 +159,48 @@ def deploy_java():
     sudo(cmd, shell=False)
 
 
+@runs_once
+def explode_war():
+    """
+    Unpack the WAR locally, once for all hosts. unzip(1) keeps the entries'
+    timestamps, so unchanged files look unchanged to rsync.
+    """
+
+    require("war_file")
+
+    env.exploded_war_dir = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, env.exploded_war_dir, True)
+
+    local("unzip -q '%s' -d '%s'" % (env.war_file, env.exploded_war_dir))
+
+
+@journal.checkpoint("war")
+@tracing.phase("transfer")
+def sync_exploded_war():
+    """
+    Push the WAR as an exploded tree, so that rsync only transfers the
+    classes and resources that have changed, and then rebuild the WAR at
+    env.war_path on the remote side from that tree.
+    """
+
+    require("sudo_user", "war_path", "war_exploded_path")
+
+    explode_war()
+
+    rsync_as_user(
+        "%s/" % env.war_exploded_path,
+        "%s/" % env.exploded_war_dir,
+        env.sudo_user,
+        delete=True,
+    )
+
+    # Build alongside and move into place so the WAR is never half written.
+    cmd = "cd %s && rm -f %s.tmp && zip -q -r -X %s.tmp . && mv %s.tmp %s" % (
+        env.war_exploded_path, env.war_path, env.war_path, env.war_path,
+        env.war_path)
+    sudo(cmd, user=env.sudo_user)
+
+
 def undeploy_java():
     require("sudo_user", "tomcat_deploy_webapp", "project_name")
     cmd = "%s %s --action undeploy" % (env.tomcat_deploy_webapp, env.project_name)
@@ -137,11 +215,11 @@ def deploy_jar():
     render_settings_template()
 
     require("sudo_user")
-    require("app_config_dir", "deploy_config_dir")
+    require("app_config_dir")
     require("jar_file", "jar_path")
     require("project_name")
 
-    rsync_as_user("%s/" % env.app_config_dir, "%s/" % env.deploy_config_dir, env.sudo_user, delete=True,)
+    sync_config(env.app_config_dir)
     rsync_as_user(env.jar_path, env.jar_file, env.sudo_user)
 
 
@@ -150,4 +228,9 @@ def deploy_etl():
 
     require("project_name")
     cmd = "supervisorctl restart etl-%s" % env.project_name
-    sudo(cmd, shell=False)
+
+    with rolling.wave():
+        sudo(cmd, shell=False)
+
+
+tracing.instrument(sys.modules[__name__])
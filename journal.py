@@ -0,0 +1,325 @@
+"""
+Checkpoint journal of deploys, for resuming them after a failure.
+
+When env.deploy_journal is set, each run of a resumable deploy task is
+recorded in a local journal. The journal holds the task and its arguments,
+the checkout and version that were built, the release directory name when
+env.releases is set, and each phase as it finishes on each host. It is kept
+in `<deploy_journal>/<project_name>-<hosts>.json`, so that each set of hosts
+has its own.
+
+`yellfabric.operations.resume` runs the task of the last journal again. It
+reuses the checkout and its build if they still exist, and skips the phases
+and hosts that had already finished. A new checkout must be of the same
+revision, since some hosts may already have it.
+"""
+
+import fcntl
+import functools
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+
+import rolling
+import tracing
+import utils
+
+from fabric.api import env, require, runs_once, abort, puts
+
+
+GLOBAL = "*"
+COMPLETE = "complete"
+
+_journal = None
+_lock = threading.Lock()
+
+
+def enabled():
+    return bool(env.get("deploy_journal"))
+
+
+def path():
+    """
+    Path of the journal for env.project_name and the hosts of the run.
+    """
+
+    require("deploy_journal", "project_name")
+
+    hosts = hashlib.sha1(" ".join(sorted(utils.all_hosts()))).hexdigest()[:8]
+    return os.path.join(os.path.expanduser(env.deploy_journal),
+                        "%s-%s.json" % (env.project_name, hosts))
+
+
+def save(merge=True):
+    """
+    Write the open journal. Unless `merge` is False, phases which pipeline
+    steps in other processes have recorded in the file since it was read
+    are kept.
+    """
+
+    directory = os.path.dirname(path())
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    with open("%s.lock" % path(), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        if merge and os.path.exists(path()):
+            with open(path()) as f:
+                try:
+                    on_disk = json.load(f)
+                except ValueError:
+                    on_disk = {}
+
+            if on_disk.get("id") == _journal.get("id"):
+                for host, phases in on_disk["done"].iteritems():
+                    recorded = _journal["done"].setdefault(host, [])
+                    recorded.extend([p for p in phases if p not in recorded])
+
+        partial = "%s.partial" % path()
+        with open(partial, "w") as f:
+            json.dump(_journal, f, indent=2)
+        os.rename(partial, path())
+
+
+def phase_name(name, args=()):
+    """
+    Name under which a phase is recorded. Phases that take arguments, like
+    the directory to transfer, are recorded separately for each of them.
+    """
+
+    return " ".join([name] + [str(arg) for arg in args]).strip()
+
+
+def start(func, args, kwargs):
+    """
+    Begin a new journal for a run of `func`, unless one is already open
+    because this run is resuming or has already started.
+    """
+
+    global _journal
+
+    with _lock:
+        if _journal is not None:
+            return
+
+        _journal = {
+            "id": uuid.uuid4().hex,
+            "task": [func.__module__, func.__name__],
+            "args": list(args),
+            "kwargs": kwargs,
+            "started": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "done": {},
+        }
+
+        # Hosts that already received this release are only activated when
+        # resuming, so it must keep its name.
+        if env.get("releases"):
+            _journal["release"] = utils.release_name()
+
+        save()
+
+
+def checkout(tempdir, version):
+    """
+    Store the checkout and its version in the open journal. Aborts if the
+    journal already has a different version, because a resumed deploy's new
+    checkout would then give the remaining hosts another revision than the
+    ones that have finished, e.g. when its branch has moved on.
+    """
+
+    if _journal is None:
+        return
+
+    expected = _journal.get("version")
+    if expected:
+        key = "commit" if expected.get("commit") and version.get("commit") \
+            else "rev"
+        if expected.get(key) != version.get(key):
+            abort("The deploy being resumed was of %s, but %s is now at %s. "
+                  "Deploy it again instead." % (
+                      expected.get("rev"), expected.get("branch"),
+                      version.get("rev")))
+
+    note(tempdir=tempdir, version=version)
+
+
+def note(**values):
+    """
+    Store values, such as the checkout, in the open journal.
+    """
+
+    if _journal is None:
+        return
+
+    with _lock:
+        _journal.update(values)
+        save()
+
+
+def done(phase, host=None):
+    if _journal is None:
+        return False
+
+    return phase in _journal["done"].get(host or env.host_string, [])
+
+
+def record(phase, host=None):
+    if _journal is None:
+        return
+
+    with _lock:
+        _journal["done"].setdefault(host or env.host_string, []).append(phase)
+        save()
+
+
+def remember(name, value):
+    """
+    Record a value chosen for the current host, such as the colour of a
+    blue/green deploy, so that a resumed run makes the same choice. It is
+    kept as the phase `<name> <value>`, unless one is already recorded.
+    """
+
+    if _journal is not None and recall(name) is None:
+        record(phase_name(name, [value]))
+
+
+def recall(name):
+    """
+    The value that remember() recorded for the current host, or None.
+    """
+
+    if _journal is None:
+        return None
+
+    for phase in _journal["done"].get(env.host_string, []):
+        if phase.startswith("%s " % name):
+            return phase[len(name) + 1:]
+
+    return None
+
+
+def checkpoint(name, per_host=True):
+    """
+    Decorator which records each call of a function as a finished phase,
+    and skips calls whose phase has already finished, while a journal is
+    open. Phases that only run once per deploy, rather than once per host,
+    should set `per_host` to False.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _journal is None:
+                return func(*args, **kwargs)
+
+            phase = phase_name(name, args)
+            host = env.host_string if per_host else GLOBAL
+
+            if done(phase, host):
+                puts("Skipping %s, finished by an earlier run" % phase)
+                return None
+
+            result = func(*args, **kwargs)
+            record(phase, host)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def resumable(func):
+    """
+    Decorator for deploy tasks which opens a journal for the run, when
+    env.deploy_journal is set, and skips hosts that the task has already
+    finished on. A host whose deploy fails at any phase is marked failed for
+    rolling restarts, and one whose deploy finishes is marked ready, in case
+    it was never restarted.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            if not enabled():
+                result = func(*args, **kwargs)
+            else:
+                start(func, args, kwargs)
+
+                if done(COMPLETE):
+                    puts("Skipping, finished by an earlier run")
+                    result = None
+                else:
+                    result = func(*args, **kwargs)
+                    record(COMPLETE)
+        except BaseException:
+            rolling.fail()
+            raise
+
+        rolling.skip()
+        return result
+
+    return wrapper
+
+
+@runs_once
+def resume():
+    """
+    Open the last journal for the hosts of the run and return the task it
+    recorded and its arguments, as `(func, args, kwargs)`.
+
+    If its checkout still exists it is used instead of fetching the source
+    again, and otherwise the build is run again on a new checkout, which
+    checkout() requires to be of the same revision.
+    """
+
+    global _journal
+
+    if not os.path.exists(path()):
+        abort("No deploy of %s to %s to resume" % (
+            env.project_name, ", ".join(utils.all_hosts())))
+
+    with open(path()) as f:
+        journal = json.load(f)
+
+    hosts = utils.all_hosts()
+    if all([COMPLETE in journal["done"].get(h, []) for h in hosts]):
+        abort("The deploy started at %s finished on every host" %
+              journal["started"])
+
+    tempdir = journal.get("tempdir")
+    if tempdir and os.path.isdir(tempdir):
+        puts("Resuming deploy of %s started at %s from %s" % (
+            journal.get("version", {}).get("rev"), journal["started"], tempdir))
+
+        # Both are runs_once, so seeding them skips the fetch.
+        utils.fetch_source.return_value = tempdir
+        if journal.get("version"):
+            utils.scm_get_info.return_value = journal["version"]
+    else:
+        puts("Resuming deploy started at %s with a new checkout" %
+             journal["started"])
+        journal.pop("tempdir", None)
+        journal["done"][GLOBAL] = [phase for phase in
+                                   journal["done"].get(GLOBAL, [])
+                                   if not phase.startswith("build")]
+
+    if journal.get("release"):
+        # runs_once, so every host uses the release it was transferred to.
+        utils.release_name.return_value = journal["release"]
+
+    _journal = journal
+    save(merge=False)
+
+    module, name = journal["task"]
+    func = getattr(sys.modules[module], name)
+
+    return func, journal["args"], dict([(str(key), value) for key, value in
+                                        journal["kwargs"].iteritems()])
+
+
+tracing.instrument(sys.modules[__name__])
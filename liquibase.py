@@ -1,28 +1,49 @@
 import os.path
-import tempfile
+import pipes
+import re
 import shutil
+import tarfile
+import tempfile
+import posixpath
+import sys
+
+from xml.dom import minidom
+from xml.parsers.expat import ExpatError
 
-from fabric.api import local, env, runs_once, require, run
-from fabric.contrib.project import rsync_project
+from fabric.api import env, runs_once, require, run, put, puts, hide, settings
 from fabric.context_managers import cd
 
+import tracing
+from utils import file_checksum, rsync_project
+
 @runs_once
+@tracing.phase("migrate")
 def migratedb(file=''):
     setup_paths(file)
 
     require("jdbc_url", "jdbc_username", "jdbc_password", "changelog_filename")
 
-    local_tempdir = tempfile.mkdtemp()
-    local("tar -C'%s' -xzf '%s'" %
-        (local_tempdir, env.db_script_archive))
+    if env.get("liquibase_precheck") and not changes_pending():
+        puts("No pending Liquibase changesets, skipping update")
+        return
+
+    if env.get("liquibase_staging_dir"):
+        run_liquibase(stage_changelog())
+        return
 
+    # Unpack on the remote side rather than extracting and rsyncing a local
+    # copy, because the changelogs don't need rendering.
     remote_tempdir = run('mktemp -d')
-    rsync_project(
-        local_dir="%s/" % local_tempdir,
-        remote_dir="%s/" % remote_tempdir,
-        delete=True)
+    remote_archive = os.path.join(remote_tempdir, 'db-scripts.tar.gz')
+    put(env.db_script_archive, remote_archive)
+    run("tar -C'%s' -xzf '%s'" % (remote_tempdir, remote_archive))
+
+    run_liquibase(remote_tempdir)
 
-    with cd(os.path.join(remote_tempdir, 'liquibase', 'changelog')):
+    run('rm -rf %s' % (remote_tempdir))
+
+def run_liquibase(scripts_dir):
+    with cd(os.path.join(scripts_dir, 'liquibase', 'changelog')):
         run("sh /usr/bin/liquibase" +
             " --driver=com.mysql.jdbc.Driver" +
             " --classpath=/usr/share/java/mysql-connector-java.jar" +
@@ -32,8 +53,160 @@ def migratedb(file=''):
             " --changeLogFile=%s" % (env.changelog_filename) +
             " update")
 
-    run('rm -rf %s' % (remote_tempdir))
-    shutil.rmtree(local_tempdir)
+def stage_changelog():
+    """
+    Keep the changelogs in a persistent directory on the remote host. When
+    the archive's checksum has changed it is extracted locally and rsynced
+    over, so only the changelogs that changed are transferred
+    """
+
+    require("liquibase_staging_dir", "project_name")
+
+    staging_dir = os.path.join(env.liquibase_staging_dir, env.project_name)
+    checksum_file = os.path.join(staging_dir, '.checksum')
+    checksum = file_checksum(env.db_script_archive)
+
+    with settings(hide('stdout', 'warnings'), warn_only=True):
+        current = run("cat %s" % checksum_file)
+
+    if current.succeeded and current.strip() == checksum:
+        puts("Changelogs unchanged, reusing %s" % staging_dir)
+        return staging_dir
+
+    run("mkdir -p %s" % staging_dir)
+
+    local_dir = tempfile.mkdtemp()
+    try:
+        scripts = tarfile.open(env.db_script_archive, "r:gz")
+        try:
+            scripts.extractall(local_dir)
+        finally:
+            scripts.close()
+
+        rsync_project(remote_dir=staging_dir, local_dir=local_dir + '/',
+                      exclude=['.checksum'], delete=True)
+    finally:
+        shutil.rmtree(local_dir)
+
+    run("echo %s > %s" % (checksum, checksum_file))
+
+    return staging_dir
+
+def changes_pending():
+    """
+    Compare the changesets in the changelog archive with the database's
+    DATABASECHANGELOG table, without starting Liquibase. Errs on the side of
+    returning True whenever either side can't be determined
+    """
+
+    changesets = archive_changesets(env.db_script_archive, env.changelog_filename)
+    if changesets is None:
+        return True
+
+    applied = applied_changesets()
+    if applied is None:
+        return True
+
+    return not changesets.issubset(applied)
+
+def archive_changesets(archive, changelog_filename):
+    """
+    Return the set of (id, author, filename) of every changeset reachable
+    from `changelog_filename` in the archive, following <include> and
+    <includeAll>. The filename is the path that Liquibase records when run
+    from the changelog directory. Returns None for changelogs that aren't
+    XML, contain changesets which run always or on change, or whose
+    recorded filename can't be worked out unambiguously
+    """
+
+    base = 'liquibase/changelog'
+    changelogs = {}
+
+    scripts = tarfile.open(archive, "r:gz")
+    try:
+        for member in scripts:
+            name = posixpath.normpath(member.name)
+            if member.isfile() and name.startswith(base + '/'):
+                changelogs[posixpath.relpath(name, base)] = scripts.extractfile(member).read()
+    finally:
+        scripts.close()
+
+    changesets = set()
+    pending = [changelog_filename]
+    seen = set()
+
+    while pending:
+        path = pending.pop(0)
+
+        # Liquibase records paths as they are written, so only plain
+        # relative ones can be matched against DATABASECHANGELOG.
+        if path != posixpath.normpath(path) or path.startswith('/') or ':' in path:
+            return None
+
+        if path in seen:
+            continue
+        seen.add(path)
+
+        if not path.endswith('.xml') or path not in changelogs:
+            return None
+
+        try:
+            dom = minidom.parseString(changelogs[path])
+        except ExpatError:
+            return None
+
+        directory = posixpath.dirname(path)
+        filename = dom.documentElement.getAttribute('logicalFilePath') or path
+
+        for changeset in dom.getElementsByTagName('changeSet'):
+            if changeset.getAttribute('runAlways') == 'true' or \
+                    changeset.getAttribute('runOnChange') == 'true':
+                return None
+
+            key = (changeset.getAttribute('id'), changeset.getAttribute('author'),
+                   changeset.getAttribute('logicalFilePath') or filename)
+            if key in changesets:
+                return None
+            changesets.add(key)
+
+        for include in dom.getElementsByTagName('include'):
+            included = include.getAttribute('file')
+            if include.getAttribute('relativeToChangelogFile') == 'true':
+                included = posixpath.join(directory, included)
+            pending.append(included)
+
+        for include in dom.getElementsByTagName('includeAll'):
+            included = include.getAttribute('path').rstrip('/')
+            if include.getAttribute('relativeToChangelogFile') == 'true':
+                included = posixpath.join(directory, included)
+            pending.extend(sorted([x for x in changelogs if posixpath.dirname(x) == included]))
+
+    return changesets
+
+def applied_changesets():
+    """
+    Return the set of (id, author, filename) recorded in DATABASECHANGELOG,
+    using the mysql client on the remote host. Returns None if it can't be
+    read
+    """
+
+    match = re.match(r'jdbc:mysql://([^:/]+)(?::(\d+))?/([^?]+)', env.jdbc_url)
+    if not match:
+        return None
+
+    host, port, database = match.groups()
+
+    with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+        out = run("MYSQL_PWD=%s mysql --batch --skip-column-names -h %s -P %s -u %s %s "
+                  "-e 'SELECT ID, AUTHOR, FILENAME FROM DATABASECHANGELOG'"
+                  % (pipes.quote(env.jdbc_password), pipes.quote(host), port or 3306,
+                     pipes.quote(env.jdbc_username), pipes.quote(database)))
+
+    if out.failed:
+        return None
+
+    return set([tuple(line.split('\t', 2)) for line in out.splitlines()
+                if line.count('\t') == 2])
 
 @runs_once
 def setup_paths(file):
@@ -42,3 +215,6 @@ def setup_paths(file):
        env.db_script_archive = "%s-liquibase.tar.gz" % env.project_name
     else:
        env.db_script_archive = file
+
+
+tracing.instrument(sys.modules[__name__])
@@ -5,16 +5,20 @@ import play
 import play2
 import static
 import utils
+import tracing
+import extdata
+import facts
+import journal
 
-import csv
 import os.path
+import sys
 import pprint
 import glob
 import json
+import tempfile
 
-from fabric.api import env, require, runs_once, local
+from fabric.api import env, require, runs_once, local, puts
 from fabric.utils import abort
-from fabric.contrib.project import rsync_project
 from fabric.operations import prompt
 
 
@@ -49,33 +53,257 @@ def scm_echo_info():
     pprint.pprint(utils.scm_get_info(env.scm_type))
 
 
-def rsync_from_local(local_path):
+def resume():
+    """
+    Continue the last deploy to the same hosts from where it failed, reusing
+    its checkout and build. Requires env.deploy_journal.
     """
-    Push a local checkout of the code to a remote machine.
 
-    local_subdir specifies the subdirectory of the project to be
-    synced (e.g. build/).
+    require("deploy_journal")
+
+    func, args, kwargs = journal.resume()
+    func(*args, **kwargs)
+
+
+def echo_facts():
+    """
+    Print the facts gathered about the current host.
     """
 
-    require("tempdir", "project_path", "sudo_user")
+    pprint.pprint(facts.host_facts())
+
+
+def rsync_settings():
+    """
+    Return the exclude list, extra options and remote directory used when
+    pushing a local checkout to env.project_path.
+
+    With env.releases the checkout is pushed to a new release directory
+    instead, which is created by the remote rsync, and files that are
+    unchanged from the live release are hardlinked rather than sent.
+    """
 
     rsync_exclude = ["*.pyc"]
     rsync_opts = []
+    remote_dir = env.project_path
 
     if env.get("rsync_exclude"):
         rsync_exclude = rsync_exclude + env.rsync_exclude
 
+    sudo_prefix = ""
     if env.sudo_user:
-        rsync_opts = '--rsync-path="sudo -u %s rsync"' % env.sudo_user
+        sudo_prefix = "sudo -u %s " % env.sudo_user
+    rsync_path = "%srsync" % sudo_prefix
 
-    rsync_project(
-        local_dir=os.path.join(env.tempdir, local_path),
-        remote_dir="%s/" % env.project_path,
-        exclude=rsync_exclude,
-        delete=True,
+    if env.get("releases"):
+        releases = utils.releases_path(env.project_path)
+        remote_dir = os.path.join(releases, utils.release_name())
+        rsync_opts.append("--link-dest=%s/" % env.project_path)
+        rsync_path = "%smkdir -p %s && %s" % (sudo_prefix, releases, rsync_path)
+
+    if rsync_path != "rsync":
+        rsync_opts.append('--rsync-path="%s"' % rsync_path)
+
+    return rsync_exclude, " ".join(rsync_opts), "%s/" % remote_dir
+
+
+@journal.checkpoint("transfer")
+@tracing.phase("transfer")
+def rsync_from_local(local_path):
+    """
+    Push a local checkout of the code to a remote machine.
+
+    local_subdir specifies the subdirectory of the project to be
+    synced (e.g. build/).
+
+    With env.transfer_manifest only the paths that differ from the manifest
+    left by the previous deploy are transferred, so rsync doesn't have to
+    scan the whole remote tree, unless env.manifest_full_verify is set.
+    """
+
+    require("tempdir", "project_path", "sudo_user")
+
+    rsync_exclude, rsync_opts, remote_dir = rsync_settings()
+    local_dir = os.path.join(env.tempdir, local_path)
+
+    if not _use_manifest():
+        utils.rsync_project(
+            local_dir=local_dir,
+            remote_dir=remote_dir,
+            exclude=rsync_exclude,
+            delete=True,
+            extra_opts=rsync_opts)
+        return
+
+    manifest = _write_manifest(local_dir, tuple(rsync_exclude))
+
+    remote = None
+    if not env.get("manifest_full_verify"):
+        remote = utils.read_remote_manifest(remote_dir)
+
+    # The manifest is always sent last, so that an interrupted transfer
+    # leaves the previous one in place and is retried in full next time.
+    rsync_exclude = rsync_exclude + ["/%s" % utils.MANIFEST_NAME]
+
+    if remote is None:
+        puts("No usable remote manifest, transferring the whole tree")
+        utils.rsync_project(
+            local_dir=local_dir,
+            remote_dir=remote_dir,
+            exclude=rsync_exclude,
+            delete=True,
+            extra_opts=rsync_opts)
+    else:
+        changes = utils.manifest_changes(manifest, remote)
+        puts("Transferring %d changed or deleted path(s) of %d" % (
+            len(changes), len(manifest)))
+
+        if changes:
+            files_from = tempfile.NamedTemporaryFile()
+            files_from.write("".join(["%s\n" % path for path in changes]))
+            files_from.flush()
+
+            # Deleted paths are in the list too, and removed on the host.
+            utils.rsync_project(
+                local_dir=local_dir,
+                remote_dir=remote_dir,
+                exclude=rsync_exclude,
+                extra_opts="--files-from=%s --delete-missing-args %s" % (
+                    files_from.name, rsync_opts))
+            files_from.close()
+
+    utils.rsync_project(
+        local_dir=os.path.join(local_dir, utils.MANIFEST_NAME),
+        remote_dir=remote_dir,
         extra_opts=rsync_opts)
 
 
+@runs_once
+@tracing.phase("transfer")
+def rsync_to_hosts(local_path, dirty=False):
+    """
+    Push a local checkout of the code to every host of the run at once.
+
+    Transfers run concurrently, at most env.fan_out_pool_size at a time,
+    and each host's output is printed when its transfer has finished. Hosts
+    skipped by env.skip_current_hosts, or which a resumed deploy already
+    transferred to, aren't transferred to.
+    """
+
+    require("tempdir", "project_path", "sudo_user")
+
+    rsync_exclude, rsync_opts, remote_dir = rsync_settings()
+    local_dir = os.path.join(env.tempdir, local_path)
+
+    current = facts.current_hosts(dirty=dirty)
+    phase = journal.phase_name("transfer", [local_path])
+    hosts = [h for h in utils.all_hosts()
+             if h not in current and not journal.done(phase, h)]
+
+    manifest = None
+    if _use_manifest():
+        _write_manifest(local_dir, tuple(rsync_exclude))
+        manifest = os.path.join(local_dir, utils.MANIFEST_NAME)
+        rsync_exclude = rsync_exclude + ["/%s" % utils.MANIFEST_NAME]
+
+    commands = {}
+    for host_string in hosts:
+        commands[host_string] = utils.rsync_command(
+            host_string,
+            local_dir,
+            remote_dir,
+            exclude=rsync_exclude,
+            delete=True,
+            extra_opts=rsync_opts,
+        )
+
+        # Send the manifest only once the tree is complete.
+        if manifest:
+            commands[host_string] += " && " + utils.rsync_command(
+                host_string, manifest, remote_dir, extra_opts=rsync_opts)
+
+    results = utils.local_parallel(commands, env.get("fan_out_pool_size", 10))
+
+    for host_string in hosts:
+        if results.get(host_string) == 0:
+            journal.record(phase, host_string)
+
+    failed = [h for h in hosts if results.get(h) != 0]
+    if failed:
+        abort("rsync failed for host(s): %s" % ", ".join(failed))
+
+
+def _use_manifest():
+    # Each release starts empty, so it is always transferred in full.
+    return env.get("transfer_manifest") and not env.get("releases")
+
+
+@runs_once
+def _write_manifest(local_dir, exclude):
+    """
+    Write the manifest of the checkout once, for every host.
+    """
+
+    with tracing.phase("manifest"):
+        return utils.write_manifest(local_dir, exclude)
+
+
+@journal.checkpoint("activate")
+@tracing.phase("activate")
+def activate_release(release=None):
+    """
+    Switch env.project_path to a release, by default the one created by this
+    run, and remove all but the newest env.keep_releases releases. Aborts if
+    the release isn't on the host, e.g. because a resumed deploy's transfer
+    to it was journaled but the directory has since been removed.
+    """
+
+    require("project_path", "sudo_user")
+
+    release = release or utils.release_name()
+    if release not in utils.list_releases(env.project_path, env.sudo_user):
+        abort("Release %s is missing from %s, not activating it" % (
+            release, utils.releases_path(env.project_path)))
+
+    if env.get("rsync_exclude"):
+        utils.carry_excluded(env.project_path, release, env.rsync_exclude,
+                             env.sudo_user)
+
+    utils.activate_release(env.project_path, release, env.sudo_user)
+    utils.prune_releases(env.project_path, int(env.keep_releases),
+                         env.sudo_user)
+
+
+def rollback_release(release=None):
+    """
+    Switch env.project_path back to the release before the live one, or to
+    the named release. The releases are listed by `list_releases`.
+    """
+
+    require("project_path", "sudo_user")
+
+    current, release = utils.rollback_target(env.project_path, release,
+                                             env.sudo_user)
+
+    puts("Rolling back from %s to %s" % (current, release))
+
+    with tracing.phase("activate"):
+        utils.activate_release(env.project_path, release, env.sudo_user)
+
+
+def list_releases():
+    """
+    List the releases on each host, marking the live one.
+    """
+
+    require("project_path", "sudo_user")
+
+    current = utils.current_release(env.project_path, env.sudo_user)
+
+    for release in utils.list_releases(env.project_path, env.sudo_user):
+        puts("%s %s" % ("*" if release == current else " ", release))
+
+
 @runs_once
 def use_maven_build():
     require("war_path", provided_by="setup_paths")
@@ -113,26 +341,95 @@ def fetch_render_copy(ref=None, debug=False, dirty=False, copy_remote=False,
                       build_local_cmd=None, local_path=""):
     """
     Fetch source code, render settings file, push remotely and delete checkout.
+
+    When env.fan_out is set the fetch, render and build happen only once and
+    the result is pushed to all hosts concurrently by rsync_to_hosts().
+
+    When env.releases is set the code is pushed to a new release directory,
+    which then replaces the live one with activate_release().
+    """
+
+    if copy_remote and env.get("fan_out"):
+        _fetch_render_fan_out(ref, debug, dirty, build_local_cmd, local_path)
+    else:
+        _fetch_render_build(ref, debug, dirty, build_local_cmd)
+
+        if copy_remote:
+            rsync_from_local(local_path)
+
+    # Later steps of every host may still read the checkout, so it is only
+    # removed once the last host has got this far.
+    utils.delete_source_conditional(env.tempdir, dirty)
+
+    if copy_remote and env.get("releases"):
+        activate_release()
+
+
+def _fetch_render_build(ref, debug, dirty, build_local_cmd):
+    """
+    Fetch source code into env.tempdir, render settings and run the build.
     """
 
     require("scm_type", "scm_url", "config_source", "config_target", "settings_vars")
 
-    env.tempdir = utils.fetch_source(env.scm_type, env.scm_url, ref, dirty)
+    with tracing.phase("fetch"):
+        env.tempdir = utils.fetch_source(env.scm_type, env.scm_url, ref, dirty)
+
+    if journal.enabled():
+        journal.checkout(env.tempdir, utils.scm_get_info(env.scm_type))
+
+        # The checkout is shared by every host, so it is only built once.
+        if journal.done("build", journal.GLOBAL):
+            return
+
+    _render_build(debug, dirty, build_local_cmd)
+    journal.record("build", journal.GLOBAL)
+
+
+def _render_build(debug, dirty, build_local_cmd):
+    """
+    Render settings into env.tempdir and run the build.
+    """
+
     config_source = os.path.join(env.tempdir, env.config_source)
     config_target = os.path.join(env.tempdir, env.config_target)
 
-    utils.render_settings_template(config_source, config_target, env.settings_vars, debug)
-    
-    utils.render_custom_templates(env.tempdir, env.settings_vars, debug)
+    with tracing.phase("render"):
+        utils.render_settings_template(config_source, config_target, env.settings_vars, debug)
+
+        utils.render_custom_templates(env.tempdir, env.settings_vars, debug)
 
     # Don't try to handle any errors here - the deploy should fail.
     if build_local_cmd:
-        build_local_cmd(env.tempdir)
+        # Local changes aren't described by the version, so never cache them.
+        cache_key = None
+        if not dirty:
+            cache_inputs = [env.config_target] + \
+                [f["dest"] for f in env.get("custom_config_files", [])]
+            cache_key = utils.build_cache_key(env.tempdir, build_local_cmd,
+                                              cache_inputs)
 
-    if copy_remote:
-        rsync_from_local(local_path)
+        if cache_key and utils.build_cache_restore(env.tempdir, cache_key):
+            return
 
-    utils.delete_source_conditional(env.tempdir, dirty)
+        with tracing.phase("build"):
+            build_local_cmd(env.tempdir)
+
+        if cache_key:
+            utils.build_cache_store(
+                env.tempdir, cache_key,
+                utils.build_cache_paths(env.tempdir, build_local_cmd))
+
+
+@runs_once
+def _fetch_render_fan_out(ref, debug, dirty, build_local_cmd, local_path):
+    """
+    Build once and push to every host. This only runs for the first host,
+    and the checkout is kept for the steps that follow on each host.
+    """
+
+    _fetch_render_build(ref, debug, dirty, build_local_cmd)
+    rsync_to_hosts(local_path, dirty)
 
 
 def render_ci_props(scm_type="git"):
@@ -185,41 +482,57 @@ def render_settings_template(debug=False):
     utils.render_custom_templates(".", env.settings_vars, debug)
                 
 
-def load_extdata(filename):
+def load_extdata(*filenames):
     """
-    Populate env.extdata as a dictionary of Puppet's extlookup/extdata
+    Populate env.extdata with a store of Puppet's extlookup/extdata
     key+value entries for later use by extlookup().
 
-    Takes a single CSV file as a mandatory argument.
+    Takes one or more CSV files, in order of precedence, which may contain
+    env placeholders such as `secrets-%(environment)s.csv`. The files are
+    only read on the first lookup, and loading the same files again in the
+    same run is free.
     """
 
-    filename = os.path.expanduser(filename)
-    if not os.path.exists(filename):
-        abort("File %r not found" % filename)
+    if not filenames:
+        abort("load_extdata requires at least one CSV file")
+
+    if isinstance(env.get("extdata"), extdata.ExtdataStore) and \
+            env.extdata.filenames == list(filenames):
+        return
 
-    extdata = csv.reader(open(filename))
-    env.extdata = {}
+    store = extdata.ExtdataStore(filenames)
 
-    for row in extdata:
-        if len(row) < 1:
-            continue
+    # Fail early for files which must exist, rather than on first lookup.
+    for filename in filenames:
+        if "%(" not in filename and \
+                not os.path.exists(os.path.expanduser(filename)):
+            abort("File %r not found" % filename)
 
-        env.extdata[row[0]] = row[1:]
+    env.extdata = store
 
 
-def extlookup(key):
+def extlookup(key, multiple=False):
     """
     Lookup a password from by Puppet's extlookup/extdata store.
     This requires that env.extdata has been populated by load_extdata()
 
-    Currently returns a single value that is only suitable for passwords.
+    Returns a single value that is suitable for passwords, or with
+    `multiple` the list of all values for the key.
     """
 
     require("extdata", provided_by="load_extdata")
 
     value = env.extdata.get(key, [])
 
+    if multiple:
+        if not value:
+            abort("Could not extlookup values for key %r" % key)
+        return value
+
     if len(value) != 1:
         abort("Could not extlookup single value for key %r" % key)
 
     return value[0]
+
+
+tracing.instrument(sys.modules[__name__])
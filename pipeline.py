@@ -0,0 +1,220 @@
+"""
+Dependency graph scheduler for deploy pipelines.
+
+A deploy is declared as a Pipeline of steps, each naming the steps that it
+requires. Steps run in the order they were added unless
+env.concurrent_pipelines is set. In that case each step starts as soon as
+the steps it requires have finished, and a summary with the critical path
+is printed at the end.
+
+Fabric's env, and with it settings(), cd(), prefix() and hide(), is global
+to the process, so steps can't safely share it between threads. Instead,
+local steps always run in the Fabric process, where they may set env and
+runs_once state for later steps. Remote steps run in a forked child with its
+own SSH connection while anything else is running, and otherwise in the
+Fabric process. A remote step must therefore only act on the host, and
+not change env for the steps after it.
+"""
+
+import multiprocessing
+import Queue
+import time
+import traceback
+
+import tracing
+
+from fabric import state
+from fabric.api import env, abort, puts
+
+
+class Step(object):
+
+    def __init__(self, name, func, requires=(), remote=False):
+        self.name = name
+        self.func = func
+        self.requires = list(requires)
+        self.remote = remote
+        self.start = None
+        self.end = None
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+
+class Pipeline(object):
+    """
+    A graph of deploy steps.
+
+        deploy = pipeline.Pipeline("deploy_django")
+        deploy.add("virtualenv", create_virtualenv, remote=True)
+        deploy.add("code", fetch_code)
+        deploy.add("requirements", pip_requirements,
+                   requires=["virtualenv", "code"], remote=True)
+        deploy.run()
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.steps = []
+
+    def add(self, name, func, requires=(), remote=False):
+        """
+        Add a step which calls `func` with no arguments. Every step in
+        `requires` must already have been added. Set `remote` for steps
+        which only act on the host, and so may run in a forked process.
+        Steps that are runs_once, or that set env, must not be remote.
+        """
+
+        names = [step.name for step in self.steps]
+        for required in requires:
+            if required not in names:
+                abort("Step %r of %s requires unknown step %r" % (
+                    name, self.name, required))
+
+        self.steps.append(Step(name, func, requires, remote))
+
+    def run(self):
+        if env.get("concurrent_pipelines"):
+            self.run_concurrent()
+            for line in self.summary():
+                puts(line, show_prefix=False)
+        else:
+            for step in self.steps:
+                self.run_step(step)
+
+    def run_step(self, step):
+        step.start = time.time()
+        step.func()
+        step.end = time.time()
+
+    def run_concurrent(self):
+        pending = list(self.steps)
+        finished = set()
+        children = {}
+        results = multiprocessing.Queue()
+
+        while pending or children:
+            self.collect(children, results, finished, block=False)
+
+            ready = [step for step in pending
+                     if not [r for r in step.requires if r not in finished]]
+
+            if not ready:
+                if not children:
+                    abort("Steps %s of %s can't be started" % (
+                        ", ".join([step.name for step in pending]), self.name))
+                self.collect(children, results, finished, block=True)
+                continue
+
+            # Nothing else can run, so don't pay for a new connection.
+            if len(ready) == 1 and not children:
+                pending.remove(ready[0])
+                self.run_step(ready[0])
+                finished.add(ready[0].name)
+                continue
+
+            for step in [s for s in ready if s.remote]:
+                pending.remove(step)
+                children[step.name] = self.start_child(step, results)
+
+            local_steps = [s for s in ready if not s.remote]
+            if local_steps:
+                pending.remove(local_steps[0])
+                self.run_step(local_steps[0])
+                finished.add(local_steps[0].name)
+
+    def collect(self, children, results, finished, block):
+        """
+        Collect the remote steps that have finished, waiting for at least
+        one if `block` is set. Aborts if any of them failed.
+        """
+
+        while children:
+            try:
+                name, end, error, spans = results.get(block=block)
+            except Queue.Empty:
+                return
+
+            children.pop(name).join()
+            tracing.extend(spans)
+
+            if error:
+                for child in children.values():
+                    child.terminate()
+                abort("Step %s of %s failed: %s" % (name, self.name, error))
+
+            self.step(name).end = end
+            finished.add(name)
+            block = False
+
+    def start_child(self, step, results):
+        step.start = time.time()
+        first_span = len(tracing.recorded_spans())
+
+        def target():
+            # The parent's SSH connections can't be shared after a fork.
+            state.connections.clear()
+
+            error = None
+            try:
+                step.func()
+            except SystemExit:
+                # Fabric has already reported why it aborted.
+                error = "aborted"
+            except BaseException as e:
+                traceback.print_exc()
+                error = "%s: %s" % (e.__class__.__name__, e)
+
+            results.put((step.name, time.time(), error,
+                         tracing.recorded_spans()[first_span:]))
+
+        child = multiprocessing.Process(target=target)
+        child.start()
+        return child
+
+    def step(self, name):
+        for step in self.steps:
+            if step.name == name:
+                return step
+
+    def critical_path(self):
+        """
+        The chain of steps that determined the total time: the step that
+        finished last, then whichever of the steps it required finished last,
+        and so on.
+        """
+
+        path = []
+        steps = [s for s in self.steps if s.end is not None]
+
+        while steps:
+            step = max(steps, key=lambda s: s.end)
+            path.insert(0, step)
+            steps = [self.step(r) for r in step.requires
+                     if self.step(r).end is not None]
+
+        return path
+
+    def summary(self):
+        """
+        Lines of a table of the steps' times, followed by the critical path.
+        """
+
+        lines = ["%-24s %10s %10s" % (self.name, "start (s)", "time (s)")]
+        origin = min([s.start for s in self.steps])
+
+        for step in sorted(self.steps, key=lambda s: s.start):
+            lines.append("%-24s %10.2f %10.2f" % (
+                step.name, step.start - origin, step.duration))
+
+        path = self.critical_path()
+        total = max([s.end for s in self.steps]) - origin
+        serial = sum([s.duration for s in self.steps])
+
+        lines.append("Critical path: %s" % " -> ".join(
+            ["%s (%.2fs)" % (s.name, s.duration) for s in path]))
+        lines.append("Total %.2fs, %.2fs if run in order" % (total, serial))
+
+        return lines
+
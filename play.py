@@ -1,5 +1,11 @@
 import os
+import sys
 import context_managers
+import facts
+import journal
+import pipeline
+import rolling
+import tracing
 import utils
 import operations
 
@@ -14,6 +20,8 @@ def setup_paths():
     env.config_target = os.path.join("conf", "application.conf")
 
 
+@journal.checkpoint("dependencies")
+@tracing.phase("dependencies")
 def sync_deps():
     """
     Download project dependencies and sync modules/lib dirs.
@@ -61,6 +69,7 @@ def status():
     utils.supervisorctl("status", "play-%s" % env.project_name)
 
 
+@tracing.phase("restart")
 def restart():
     """
     Restart the application using supervisord.
@@ -68,7 +77,8 @@ def restart():
 
     require("project_name")
 
-    utils.supervisorctl("restart", "play-%s" % env.project_name)
+    with rolling.wave():
+        utils.supervisorctl("restart", "play-%s" % env.project_name)
 
 
 def start_play():
@@ -92,6 +102,8 @@ def stop_play():
 
 
 @runs_once
+@journal.checkpoint("migrate", per_host=False)
+@tracing.phase("migrate")
 def migratedb(command="apply"):
     """
     Perform database migrations using Evolutions.
@@ -101,14 +113,33 @@ def migratedb(command="apply"):
     utils.play_run(env.project_path, "evolutions:%s" % command, user=env.sudo_user)
 
 
+@journal.resumable
 def deploy_play(ref=None, debug=False, dirty=False):
     """
     Standard Play deployment actions.
     """
 
-    operations.fetch_render_copy(ref, debug, dirty, True)
-    sync_deps()
-    migratedb()
+    if facts.skip_current_host(ref, dirty):
+        return
+
+    deploy = pipeline.Pipeline("deploy_play")
+    deploy.add("code", lambda: operations.fetch_render_copy(
+        ref, debug, dirty, True))
+    deploy.add("dependencies", sync_deps, requires=["code"], remote=True)
+    deploy.add("migrate", migratedb, requires=["dependencies"])
+    deploy.add("restart", restart, requires=["migrate"], remote=True)
+    deploy.run()
+
+    facts.mark_deployed(ref, dirty)
+
+
+def rollback_play(release=None):
+    """
+    Switch back to the previous release, or to `release`, and restart.
+    Requires env.releases.
+    """
+
+    operations.rollback_release(release)
     restart()
 
 
@@ -142,3 +173,6 @@ def dirty_play_autotest(ref=None, debug=False, dirty=True):
     utils.play_run(env.project_path, "autotest -XX:CompileCommand=exclude,jregex/Pretokenizer,next" , user=env.sudo_user)
     # restart app in prod mode afterwards
     start_play()
+
+
+tracing.instrument(sys.modules[__name__])
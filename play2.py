@@ -1,9 +1,22 @@
+import glob
 import os
+import pipes
+import sys
+import tempfile
+import time
+import facts
+import journal
+import pipeline
+import rolling
 import operations
+import tracing
 import utils
-from shutil import copy
+from shutil import copy, move
+
+from fabric.api import env, require, runs_once, sudo, run, local, lcd, abort, hide, puts, settings
+
+COLOURS = ("blue", "green")
 
-from fabric.api import env, require, runs_once, sudo, local, lcd, abort
 
 def create_custom_command(dist):
     """
@@ -13,8 +26,24 @@ def create_custom_command(dist):
         if dist is True:
             package_dist()
             extract_project()
+            if env.get("play2_jar_store"):
+                store_jars()
         else:
             stage_project()
+
+    # Allow the outputs to be reused by operations.fetch_render_copy() when
+    # env.build_cache is enabled.
+    if dist is True:
+        build_cmd.cache_key = "%s dist %s-%s" % (
+            env.get("play2_bin"), env.project_name, env.project_version)
+        if env.get("play2_jar_store"):
+            # The jars have been moved out of the cached tree.
+            build_cmd.cache_key += " jar-store"
+        build_cmd.cache_paths = ["dist"]
+    else:
+        build_cmd.cache_key = "%s clean compile stage" % env.get("play2_bin")
+        build_cmd.cache_paths = ["target"]
+
     return build_cmd
 
 def stage_project():
@@ -54,11 +83,150 @@ def package_dist():
         local("%s dist" % (env.play2_bin))
 
 
+def store_jars():
+    """
+    Move the jars of the extracted dist into the local content addressed
+    store env.play2_jar_store and list them in `lib/.jar-manifest`, as
+    `<sha1> <name>` lines, for sync_jar_store() to reassemble on each host.
+
+    A copy of the manifest is kept in the store's `builds/` directory, and
+    jars that none of the last env.keep_releases builds of any project
+    refer to are removed from the store.
+    """
+
+    require("play2_jar_store", "project_name", "project_version", "tempdir")
+
+    lib_dir = os.path.join(env.tempdir, "dist", "%s-%s" % (env.project_name, env.project_version), "lib")
+    store = os.path.expanduser(env.play2_jar_store)
+    builds_dir = os.path.join(store, "builds")
+    if not os.path.exists(builds_dir):
+        os.makedirs(builds_dir)
+
+    jars = []
+    for name in sorted(os.listdir(lib_dir)):
+        if name.endswith(".jar"):
+            path = os.path.join(lib_dir, name)
+            jars.append((utils.file_checksum(path), name, path))
+
+    manifest = ["%s %s\n" % (digest, name) for digest, name, jar in jars]
+
+    # Record the build before its jars are stored, so that a concurrent
+    # prune_jar_store() never removes them.
+    build = os.path.join(builds_dir, "%s-%s" % (env.project_name, utils.release_name()))
+    with open(build, "w") as build_file:
+        build_file.writelines(manifest)
+
+    for digest, name, path in jars:
+        stored = os.path.join(store, "%s.jar" % digest)
+
+        if os.path.exists(stored):
+            os.remove(path)
+        else:
+            move(path, stored)
+
+    with open(os.path.join(lib_dir, ".jar-manifest"), "w") as manifest_file:
+        manifest_file.writelines(manifest)
+
+    prune_jar_store(store)
+
+
+def prune_jar_store(store):
+    """
+    Forget all but the last env.keep_releases builds of each project in the
+    local jar store, and remove the jars that neither the remaining builds
+    nor the dists in env.build_cache refer to.
+    """
+
+    builds_dir = os.path.join(store, "builds")
+    keep = max(int(env.get("keep_releases", 5)), 1)
+
+    # Build records are named `<project_name>-<release_name>`.
+    builds = {}
+    for name in os.listdir(builds_dir):
+        builds.setdefault(name.rsplit("-", 1)[0], []).append(name)
+
+    referenced = set()
+    for names in builds.values():
+        names.sort()
+        for name in names[:-keep]:
+            os.remove(os.path.join(builds_dir, name))
+        for name in names[-keep:]:
+            with open(os.path.join(builds_dir, name)) as build_file:
+                referenced.update([line.split()[0] for line in build_file if line.strip()])
+
+    # Restoring a cached dist needs its jars too.
+    if env.get("build_cache"):
+        pattern = os.path.join(os.path.expanduser(env.build_cache),
+                               "*", "dist", "*", "lib", ".jar-manifest")
+        for cached in glob.glob(pattern):
+            with open(cached) as manifest_file:
+                referenced.update([line.split()[0] for line in manifest_file if line.strip()])
+
+    removed = 0
+    for name in os.listdir(store):
+        if name.endswith(".jar") and name[:-len(".jar")] not in referenced:
+            os.remove(os.path.join(store, name))
+            removed += 1
+
+    if removed:
+        puts("Removed %d unused jars from %s" % (removed, store))
+
+
+@journal.checkpoint("jars")
+@tracing.phase("transfer")
+def sync_jar_store():
+    """
+    Transfer the jars listed in the deployed `lib/.jar-manifest` that aren't
+    already in the host's store at env.play2_jar_store_path, then assemble
+    `lib/` from hardlinks into the store and remove jars that are no longer
+    listed. Jars in the host's store that no deployed `lib/` links to any
+    more are removed an hour after they were last unlinked.
+    """
+
+    require("project_path", "play2_jar_store", "play2_jar_store_path", "sudo_user")
+
+    lib_dir = os.path.join(env.project_path, "lib")
+    store = env.play2_jar_store_path
+    local_store = os.path.expanduser(env.play2_jar_store)
+
+    with hide("stdout"):
+        manifest = sudo("cat %s/.jar-manifest" % lib_dir, user=env.sudo_user)
+        present = sudo("mkdir -p %s && ls %s" % (store, store), user=env.sudo_user).split()
+
+    hashes = set([line.split()[0] for line in manifest.splitlines() if line.strip()])
+    missing = sorted([h for h in hashes if "%s.jar" % h not in present])
+
+    if missing:
+        for digest in missing:
+            if not os.path.exists(os.path.join(local_store, "%s.jar" % digest)):
+                abort("Jar %s is missing from %s, rebuild without the build cache" % (digest, local_store))
+
+        files_from = tempfile.NamedTemporaryFile()
+        files_from.write("".join(["%s.jar\n" % digest for digest in missing]))
+        files_from.flush()
+
+        utils.rsync_project(
+            "%s/" % store,
+            "%s/" % local_store,
+            extra_opts='--files-from=%s --rsync-path="sudo -u %s rsync"' % (files_from.name, env.sudo_user),
+        )
+        files_from.close()
+
+    puts("Assembling lib/ from %d jars, %d transferred" % (len(hashes), len(missing)))
+
+    sudo("cd %s && "
+         "while read hash name; do ln -f %s/$hash.jar \"$name\" || exit 1; done < .jar-manifest && "
+         "for jar in *.jar; do awk '{print $2}' .jar-manifest | grep -qxF \"$jar\" || rm -f \"$jar\"; done && "
+         "find %s -maxdepth 1 -name '*.jar' -links 1 -cmin +60 -delete"
+         % (lib_dir, store, store), user=env.sudo_user)
+
+
 @runs_once
 def setup_paths():
     require("play2_root", "project_name")
 
     env.project_path = os.path.join(env.play2_root, env.project_name)
+    env.play2_jar_store_path = os.path.join(env.play2_root, ".jars")
     env.config_source = os.path.join("conf", "application.conf.template")
     env.config_target = os.path.join("conf", "application.conf")
 
@@ -72,7 +240,7 @@ def tail(stderr=False):
 
     require("project_name")
 
-    cmd = "supervisorctl tail play2-%s" % env.project_name
+    cmd = "supervisorctl tail %s" % program_name()
 
     # If 'stderr' is supplied via command line, check its validity
     if stderr == 'True':
@@ -95,9 +263,10 @@ def status():
 
     require("project_name")
 
-    utils.supervisorctl("status", "play2-%s" % env.project_name)
+    utils.supervisorctl("status", program_name())
 
 
+@tracing.phase("restart")
 def restart():
     """
     Restart the application using supervisord.
@@ -105,7 +274,8 @@ def restart():
 
     require("project_name")
 
-    utils.supervisorctl("restart", "play2-%s" % env.project_name)
+    with rolling.wave():
+        utils.supervisorctl("restart", program_name())
 
 
 def start_play():
@@ -115,7 +285,7 @@ def start_play():
 
     require("project_name")
 
-    utils.supervisorctl("start", "play2-%s" % env.project_name)
+    utils.supervisorctl("start", program_name())
 
     
 def stop_play():
@@ -125,8 +295,185 @@ def stop_play():
 
     require("project_name")
 
-    utils.supervisorctl("stop", "play2-%s" % env.project_name)
+    utils.supervisorctl("stop", program_name())
+
+
+def program_name(colour=None):
+    """
+    Name of the application's supervisor program. With env.play2_blue_green
+    this is the program of `colour`, by default the live one.
+    """
+
+    require("project_name")
+
+    if not env.get("play2_blue_green"):
+        return "play2-%s" % env.project_name
+
+    return "play2-%s-%s" % (env.project_name,
+                            colour or active_colour() or COLOURS[0])
+
+
+def colour_path(colour):
+    """
+    Directory that the release of `colour` is deployed to.
+    """
+
+    require("play2_root", "project_name")
+
+    return os.path.join(env.play2_root, "%s-%s" % (env.project_name, colour))
+
+
+def active_colour_path():
+    require("play2_root", "project_name")
+
+    return os.path.join(env.play2_root, "%s.active" % env.project_name)
+
+
+def active_colour():
+    """
+    The colour that is serving traffic on the current host, or None before
+    the first blue/green deploy.
+    """
+
+    with settings(hide("running", "stdout", "warnings"), warn_only=True):
+        out = sudo("cat %s" % active_colour_path())
+
+    if out.failed or out.strip() not in COLOURS:
+        return None
+
+    return out.strip()
+
+
+def other_colour(colour):
+    if colour == COLOURS[0]:
+        return COLOURS[1]
+
+    return COLOURS[0]
+
+
+def idle_colour():
+    """
+    The colour that the next release is deployed to on the current host.
+    """
+
+    return other_colour(active_colour())
+
+
+def point_proxy_at(colour, port):
+    """
+    Write the proxy's upstream file for `port` and the active colour marker
+    together, and reload the proxy. If the reload fails both files are put
+    back as they were, so that they keep agreeing with the running proxy,
+    and False is returned.
+    """
+
+    upstream = env.play2_upstream_template % {
+        "project_name": env.project_name,
+        "port": port,
+    }
+
+    files = {"upstream": env.play2_upstream_file, "active": active_colour_path()}
+    restore = " ".join([
+        "if [ -e %(f)s.previous ]; then mv %(f)s.previous %(f)s; else rm -f %(f)s; fi;" % {"f": f}
+        for f in files.values()])
+
+    cmd = ("cp -p %(upstream)s %(upstream)s.previous 2>/dev/null || rm -f %(upstream)s.previous; "
+           "cp -p %(active)s %(active)s.previous 2>/dev/null || rm -f %(active)s.previous; "
+           "echo %(contents)s > %(upstream)s.tmp && mv %(upstream)s.tmp %(upstream)s && "
+           "echo %(colour)s > %(active)s.tmp && mv %(active)s.tmp %(active)s && "
+           "%(reload)s; status=$?; "
+           "if [ $status -ne 0 ]; then %(restore)s fi; "
+           "rm -f %(upstream)s.previous %(active)s.previous; exit $status") % dict(
+        files, contents=pipes.quote(upstream), colour=colour,
+        reload=env.play2_proxy_reload, restore=restore)
+
+    with settings(warn_only=True):
+        return sudo(cmd).succeeded
+
+
+def stop_quietly(name):
+    """
+    Stop a supervisor program which may not be running, or may not exist.
+    """
+
+    with settings(hide("warnings"), warn_only=True):
+        sudo("supervisorctl stop %s" % name, shell=False)
+
+
+def wait_for_port(port):
+    """
+    Poll the application on `port` from the host itself until it responds,
+    for up to env.play2_ready_timeout seconds. Returns whether it did.
+    """
+
+    url = "http://127.0.0.1:%d%s" % (port, env.play2_ready_path)
 
+    # Each request is limited too, so that a process which accepts
+    # connections but never answers can't outlast the timeout.
+    cmd = ("deadline=$(($(date +%%s) + %d)); "
+           "until curl -sf --max-time 5 -o /dev/null %s; do "
+           "[ $(date +%%s) -ge $deadline ] && exit 1; sleep 1; done") % (
+        int(env.play2_ready_timeout), pipes.quote(url))
+
+    with settings(hide("running", "warnings"), warn_only=True):
+        return run(cmd).succeeded
+
+
+@journal.checkpoint("switch")
+@tracing.phase("restart")
+def switch_colour(colour):
+    """
+    Start the release in `colour` alongside the live one. Once it responds
+    on its own port, point the proxy's upstream file at it and stop the
+    colour that was live. If it never responds it is stopped again, and
+    the live colour carries on serving, as it does if the proxy can't be
+    reloaded.
+
+    On the first blue/green deploy the program from before, without a
+    colour, is stopped once the new colour is live. If `colour` is already
+    live, because a resumed deploy failed after the switch, only the other
+    colour is stopped and later waves aren't held up.
+    """
+
+    require("play2_upstream_file", "play2_blue_green_ports")
+
+    previous = active_colour()
+    port = int(env.play2_blue_green_ports[colour])
+
+    if previous == colour:
+        puts("%s is already live" % program_name(colour))
+        stop_quietly(program_name(other_colour(colour)))
+        rolling.skip()
+        return
+
+    with rolling.wave():
+        utils.supervisorctl("restart", program_name(colour))
+
+        if not wait_for_port(port):
+            utils.supervisorctl("stop", program_name(colour))
+            abort("%s did not become ready on port %d, %s is still live" % (
+                program_name(colour), port,
+                program_name(previous) if previous else "nothing"))
+
+        if not point_proxy_at(colour, port):
+            utils.supervisorctl("stop", program_name(colour))
+            abort("Couldn't reload the proxy for %s, %s is still live" % (
+                program_name(colour),
+                program_name(previous) if previous else "nothing"))
+
+        puts("Switched %s from %s to %s" % (
+            env.project_name, previous or "nothing", colour))
+
+        # Let requests already sent to the old process finish.
+        time.sleep(float(env.play2_drain_time))
+
+        if previous:
+            utils.supervisorctl("stop", program_name(previous))
+        else:
+            stop_quietly("play2-%s" % env.project_name)
+
+
+@journal.resumable
 def deploy_play2(ref=None, debug=False, dirty=False, dist=False):
     """
     Standard Play 2 deployment actions.
@@ -142,6 +489,10 @@ def deploy_play2(ref=None, debug=False, dirty=False, dist=False):
         abort('dist argument must equal True or False')
 
     require("project_name", "project_version")
+
+    if facts.skip_current_host(ref, dirty):
+        return
+
     build_cmd = create_custom_command(dist)
 
     local_build_path= ""
@@ -150,6 +501,43 @@ def deploy_play2(ref=None, debug=False, dirty=False, dist=False):
                                         ''.join([env.project_name,
                                         '-', env.project_version, os.sep]))
 
-    operations.fetch_render_copy(ref, debug, dirty, True,
-                                     build_cmd, local_build_path)
-    restart()
+    jar_store = dist and env.get("play2_jar_store")
+    if jar_store:
+        # Keep the hardlinked jars from being deleted by rsync.
+        env.rsync_exclude = env.get("rsync_exclude") or []
+        if "lib/*.jar" not in env.rsync_exclude:
+            env.rsync_exclude = env.rsync_exclude + ["lib/*.jar"]
+
+    project_path = env.project_path
+    switch = restart
+
+    if env.get("play2_blue_green"):
+        if env.get("fan_out"):
+            abort("env.fan_out can't be used with env.play2_blue_green, "
+                  "because each host deploys to its own idle colour")
+
+        # A resumed deploy must finish the colour it started on, which is
+        # already live if it failed after the switch.
+        colour = journal.recall("colour") or idle_colour()
+        journal.remember("colour", colour)
+
+        project_path = colour_path(colour)
+        switch = lambda: switch_colour(colour)
+
+    with settings(project_path=project_path):
+        deploy = pipeline.Pipeline("deploy_play2")
+        deploy.add("code", lambda: operations.fetch_render_copy(
+            ref, debug, dirty, True, build_cmd, local_build_path))
+        restart_requires = ["code"]
+
+        if jar_store:
+            deploy.add("jars", sync_jar_store, requires=["code"], remote=True)
+            restart_requires = ["jars"]
+
+        deploy.add("restart", switch, requires=restart_requires, remote=True)
+        deploy.run()
+
+    facts.mark_deployed(ref, dirty)
+
+
+tracing.instrument(sys.modules[__name__])
@@ -1,9 +1,19 @@
 import os
+import hashlib
+import pipes
+import re
+import shlex
+import sys
 import context_managers
+import facts
+import journal
+import pipeline
+import rolling
+import tracing
 import utils
 import operations
 
-from fabric.api import env, require, cd, runs_once, sudo, abort
+from fabric.api import env, require, cd, runs_once, sudo, local, puts, abort, hide, settings
 
 
 @runs_once
@@ -22,9 +32,14 @@ def setup_paths():
     env.config_target = "local_settings.py"
 
 
+@journal.checkpoint("virtualenv")
+@tracing.phase("virtualenv")
 def create_virtualenv():
     """
     Create a Python virtual environment.
+
+    With env.reuse_virtualenv this is skipped if the virtualenv was already
+    built by pip_requirements() with the same Python binary.
     """
 
     require(
@@ -34,6 +49,13 @@ def create_virtualenv():
         "https_proxy",
         "sudo_user",
     )
+
+    if env.get("reuse_virtualenv"):
+        previous = read_virtualenv_fingerprint()
+        if previous and previous.split(" ")[0] == env.python_bin:
+            puts("Reusing virtualenv %s" % env.virtualenv_path)
+            return
+
     # Added system-site-packages as environment
     # uses global packages like MySQLdb
     cmd = "virtualenv --python %s %s --system-site-packages" % (env.python_bin, env.virtualenv_path)
@@ -45,9 +67,15 @@ def create_virtualenv():
             sudo(cmd, user=env.sudo_user)
 
 
+@journal.checkpoint("requirements")
+@tracing.phase("requirements")
 def pip_requirements():
     """
     Install project requirements using PIP into a Python virtual environment.
+
+    With env.reuse_virtualenv this is skipped if the virtualenv's
+    fingerprint is unchanged, and otherwise only the requirements that
+    aren't already in `pip freeze` are installed.
     """
 
     require(
@@ -57,15 +85,173 @@ def pip_requirements():
         "https_proxy",
         "sudo_user",
     )
-    cmd = "pip install --quiet --requirement %s" % env.requirements_path
 
-    # append packages url if specified
-    if env.get("packages_url") is not None:
-        cmd += " -f %s" % env.get("packages_url")
+    fingerprint = None
+    packages = None
 
-    with context_managers.proxy(env.http_proxy, env.https_proxy):
+    if env.get("reuse_virtualenv"):
+        fingerprint = virtualenv_fingerprint()
+        previous = read_virtualenv_fingerprint()
+
+        if fingerprint == previous:
+            puts("Requirements unchanged, skipping pip")
+            return
+
+        if previous:
+            packages = changed_requirements()
+
+    if packages is None:
+        target = "--requirement %s" % env.requirements_path
+    else:
+        target = " ".join([pipes.quote(arg) for arg in packages])
+
+    http_proxy, https_proxy = env.http_proxy, env.https_proxy
+
+    if env.get("pip_wheelhouse"):
+        # Install offline from the wheels shipped by build_wheelhouse().
+        cmd = "pip install --quiet --no-index --find-links %s %s" % (
+            os.path.join(env.project_path, "wheelhouse"), target)
+        http_proxy = https_proxy = None
+    else:
+        cmd = "pip install --quiet %s" % target
+
+        # append packages url if specified
+        if env.get("packages_url") is not None:
+            cmd += " -f %s" % env.get("packages_url")
+
+    if target:
+        with context_managers.proxy(http_proxy, https_proxy):
+            with context_managers.virtualenv(env.virtualenv_path):
+                sudo(cmd, user=env.sudo_user)
+
+    if fingerprint:
+        sudo("echo %s > %s" % (pipes.quote(fingerprint), virtualenv_fingerprint_path()),
+             user=env.sudo_user)
+
+
+def virtualenv_fingerprint_path():
+    """
+    Path of the file in which pip_requirements() records the fingerprint of
+    a virtualenv.
+    """
+
+    require("virtualenv_path")
+
+    return os.path.join(env.virtualenv_path, ".yellfabric-fingerprint")
+
+
+def virtualenv_fingerprint():
+    """
+    Fingerprint of the Python binary, requirements file and packages_url
+    that the virtualenv on the current host should be built from.
+    """
+
+    require("python_bin", "requirements_path", "sudo_user")
+
+    with hide("running", "stdout"):
+        requirements_hash = sudo("sha1sum %s" % env.requirements_path,
+                                 user=env.sudo_user).split()[0]
+
+    return " ".join([env.python_bin, requirements_hash,
+                     env.get("packages_url") or ""]).strip()
+
+
+def read_virtualenv_fingerprint():
+    """
+    Fingerprint recorded for the virtualenv on the current host, or None.
+    """
+
+    require("sudo_user")
+
+    with settings(hide("running", "stdout", "warnings"), warn_only=True):
+        out = sudo("cat %s" % virtualenv_fingerprint_path(), user=env.sudo_user)
+
+    if out.failed:
+        return None
+
+    return out.strip()
+
+
+def changed_requirements():
+    """
+    Return pip arguments for the lines of the requirements file that aren't
+    already satisfied by an identical `name==version` in `pip freeze`.
+
+    Returns None if the file includes another requirements file, in which
+    case everything should be installed.
+    """
+
+    require("virtualenv_path", "requirements_path", "sudo_user")
+
+    with hide("running", "stdout"):
+        requirements = sudo("cat %s" % env.requirements_path,
+                            user=env.sudo_user).splitlines()
         with context_managers.virtualenv(env.virtualenv_path):
-            sudo(cmd, user=env.sudo_user)
+            frozen = sudo("pip freeze", user=env.sudo_user).splitlines()
+
+    frozen = set([re.sub(r"\s", "", line).lower() for line in frozen])
+    packages = []
+
+    for line in requirements:
+        line = re.sub(r"(^|\s)#.*$", "", line).strip()
+
+        if not line or re.sub(r"\s", "", line).lower() in frozen:
+            continue
+
+        if line.startswith("-r") or line.startswith("--requirement"):
+            return None
+
+        packages.extend(shlex.split(line))
+
+    return packages
+
+
+def build_wheelhouse(tempdir):
+    """
+    Build wheels of the project requirements on the deploy machine and place
+    them in the checkout as `wheelhouse/`, to be pushed with the code and
+    installed offline by pip_requirements().
+
+    Wheelhouses are cached in env.pip_wheelhouse by the hash of the
+    requirements file, so they are only rebuilt when it changes.
+    """
+
+    require("pip_wheelhouse")
+
+    requirements = os.path.join(tempdir, "requirements", "project.txt")
+    find_links = ""
+    if env.get("packages_url") is not None:
+        find_links = " -f %s" % env.get("packages_url")
+
+    with open(requirements) as requirements_file:
+        digest = hashlib.sha1(requirements_file.read() + find_links).hexdigest()
+
+    cache_dir = os.path.expanduser(env.pip_wheelhouse)
+    wheelhouse = os.path.join(cache_dir, digest)
+
+    if os.path.isdir(wheelhouse):
+        os.utime(wheelhouse, None)
+    else:
+        partial = "%s.partial" % wheelhouse
+        local("rm -rf %s" % partial)
+        local("pip wheel --quiet --wheel-dir %s --requirement %s%s" % (
+            partial, requirements, find_links))
+        os.rename(partial, wheelhouse)
+
+    local("cp -a %s %s" % (wheelhouse, os.path.join(tempdir, "wheelhouse")))
+
+    utils.prune_cache(cache_dir, env.get("pip_wheelhouse_max_size"))
+
+
+def wheelhouse_build_cmd():
+    """
+    The build_local_cmd for operations.fetch_render_copy(), if any.
+    """
+
+    if env.get("pip_wheelhouse"):
+        return build_wheelhouse
+
+    return None
 
 
 def render_settings_template(debug=False):
@@ -90,6 +276,7 @@ def render_settings_template(debug=False):
     utils.template_to_file(source, target, context)
 
 
+@tracing.phase("restart")
 def refresh_wsgi():
     """
     Touch a WSGI file so that Apache w/mod_wsgi reloads a project.
@@ -97,7 +284,9 @@ def refresh_wsgi():
 
     require("wsgi_path", "sudo_user")
     cmd = "touch -c %s" % env.wsgi_path
-    sudo(cmd, user=env.sudo_user)
+
+    with rolling.wave():
+        sudo(cmd, user=env.sudo_user)
 
 
 @runs_once
@@ -116,6 +305,8 @@ def syncdb():
 
 
 @runs_once
+@journal.checkpoint("migrate", per_host=False)
+@tracing.phase("migrate")
 def migratedb(rollback=False):
     """
     Perform 'migrate' action for a Django project.
@@ -123,6 +314,10 @@ def migratedb(rollback=False):
 
     require("virtualenv_path", "project_path", "sudo_user")
 
+    if env.get("batch_migrations"):
+        migrate_batch(rollback)
+        return
+
     #
     # Some things need to be done first (i.e. if they need a different
     # database connection or some custom args)
@@ -157,6 +352,117 @@ def migratedb(rollback=False):
         migrate_app_db()
 
 
+def migrate_batch(rollback=False):
+    """
+    Perform the same migrations as migratedb() using at most two Django
+    processes: one to list which apps have pending migrations and, only if
+    there are any, one to apply all of them.
+    """
+
+    require("virtualenv_path", "project_path", "sudo_user")
+
+    targets = []
+
+    if "migratedb_first" in env:
+        for app, args in env.migratedb_first.iteritems():
+            targets.append((app, get_south_migrate_version(app, rollback), args))
+
+    if has_version_info():
+        for app in env.south_migrations.keys():
+            targets.append((app, get_south_migrate_version(app, rollback), None))
+    else:
+        targets.append((None, None, None))
+
+    with hide("stdout"):
+        state = south_migration_state(utils.django_manage_run(
+            env.virtualenv_path,
+            env.project_path,
+            "migrate --list",
+            env.sudo_user,
+        ))
+
+    pending = [t for t in targets if migration_pending(state, *t)]
+
+    if not pending:
+        puts("No pending migrations")
+        return
+
+    commands = []
+    for app, version, args in pending:
+        command = ["migrate"]
+        if app:
+            command.extend([app, version])
+        if args:
+            command.extend(shlex.split(args))
+        command.append("--noinput")
+        commands.append(command)
+
+    puts("Applying: %s" % "; ".join([" ".join(c) for c in commands]))
+
+    utils.django_manage_batch(
+        env.virtualenv_path,
+        env.project_path,
+        commands,
+        env.sudo_user,
+    )
+
+
+def south_migration_state(output):
+    """
+    Parse the output of South's `migrate --list` into a dictionary of
+    `{app: [(migration, applied), ...]}`.
+    """
+
+    state = {}
+    migrations = None
+
+    for line in output.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+
+        if line.startswith("(*)") or line.startswith("( )"):
+            if migrations is not None:
+                migrations.append((line[3:].strip(), line.startswith("(*)")))
+        else:
+            migrations = state.setdefault(line, [])
+
+    return state
+
+
+def migration_pending(state, app, version, args):
+    """
+    Whether migrating `app` to `version` would do anything, according to the
+    output of south_migration_state(). Apps with custom args may target a
+    different database, so they are always migrated.
+    """
+
+    if args:
+        return True
+
+    if app is None:
+        return any([not applied for migrations in state.values()
+                    for name, applied in migrations])
+
+    if app not in state:
+        return True
+
+    names = [name for name, applied in state[app]]
+    applied = [name for name, applied in state[app] if applied]
+
+    if version in (None, "auto"):
+        return len(applied) != len(names)
+
+    if version == "zero":
+        return bool(applied)
+
+    matches = [name for name in names if name.startswith(version)]
+    if not matches:
+        return True
+
+    return applied != names[:names.index(matches[0]) + 1]
+
+
 def migrate_app_db(app=None, version=None, args=None):
 
     require("virtualenv_path", "project_path", "sudo_user")
@@ -229,23 +535,58 @@ def create_superuser(username=None, email=None):
     )
 
 
+@journal.resumable
 def deploy_django(ref=None, debug=False, dirty=False):
     """
     Standard Django deployment actions.
     """
 
-    create_virtualenv()
-    operations.fetch_render_copy(ref, debug, dirty, True)
-    pip_requirements()
-    migratedb()
-    refresh_wsgi()
+    if facts.skip_current_host(ref, dirty):
+        return
+
+    # Creating the virtualenv on the host overlaps the local fetch and build
+    # when env.concurrent_pipelines is set.
+    deploy = pipeline.Pipeline("deploy_django")
+    deploy.add("virtualenv", create_virtualenv, remote=True)
+    deploy.add("code", lambda: operations.fetch_render_copy(
+        ref, debug, dirty, True, wheelhouse_build_cmd()))
+    deploy.add("requirements", pip_requirements,
+               requires=["virtualenv", "code"], remote=True)
+    deploy.add("migrate", migratedb, requires=["requirements"])
+    deploy.add("restart", refresh_wsgi, requires=["migrate"], remote=True)
+    deploy.run()
 
+    facts.mark_deployed(ref, dirty)
 
-def rollback_django(ref=None, debug=False, dirty=False):
+
+def rollback_django(ref=None, debug=False, dirty=False, release=None):
     """
     There is nothing standard about rolling back.
+
+    With env.releases the database is rolled back using the migrations of
+    the live release, and the requirements of the previous release, or of
+    `release`, are installed before switching back to it, without fetching
+    anything.
     """
-    if has_version_info():
+    if env.get("releases"):
+        require("project_path", "sudo_user")
+
+        current, release = utils.rollback_target(env.project_path, release,
+                                                 env.sudo_user)
+        release_path = os.path.join(utils.releases_path(env.project_path),
+                                    release)
+
+        if has_version_info():
+            migratedb(True)
+
+        with settings(project_path=release_path,
+                      requirements_path=os.path.join(release_path, "requirements", "project.txt")):
+            pip_requirements()
+
+        operations.rollback_release(release)
+        refresh_wsgi()
+
+    elif has_version_info():
         #
         # To roll back we need to fetch the existing version, execute the
         # database rollback, and then do a deploy of a specific version
@@ -261,10 +602,14 @@ def rollback_django(ref=None, debug=False, dirty=False):
 
         # Get the old code
         del env['tempdir']
-        operations.fetch_render_copy(env.scm_tag["rollback"], debug, dirty, True)
+        operations.fetch_render_copy(env.scm_tag["rollback"], debug, dirty, True,
+                                     wheelhouse_build_cmd())
 
         pip_requirements()
         refresh_wsgi()
 
     else:
         abort("No version info present to allow rollback")
+
+
+tracing.instrument(sys.modules[__name__])
@@ -0,0 +1,211 @@
+"""
+Rolling restarts in waves, gated on a readiness check.
+
+When env.rolling_restart is set, the hosts of the run are split into waves:
+a canary wave of the first env.rolling_canary hosts, followed by waves of
+env.rolling_wave_size hosts. After a host restarts, env.readiness_check is
+polled from the deploy machine until it passes. If it doesn't pass within
+env.readiness_timeout seconds, the deploy aborts.
+
+Each host also waits until every host in the earlier waves has passed its
+check before restarting. If one of them fails, including any host of the
+canary wave, the other hosts abort without restarting. A host also counts as
+failed if its deploy fails before the restart, see fail(). Hosts that aren't
+restarted by the run must call skip() so that later waves don't wait for
+them, which journal.resumable does once a deploy task has finished. In
+serial execution the earlier hosts have already finished by the time a
+host's turn comes, so it doesn't wait.
+
+See rolling_check.py for a check of the ordering against local HTTP
+servers.
+"""
+
+import atexit
+import httplib
+import os
+import shutil
+import socket
+import tempfile
+import time
+import urllib2
+import urlparse
+
+from contextlib import contextmanager
+
+import tracing
+import utils
+
+from fabric.api import env, abort, puts
+
+
+# Shared by the processes that Fabric forks for each host in parallel mode.
+_state_dir = os.path.join(tempfile.gettempdir(),
+                          "yellfabric-rolling-%d" % os.getpid())
+atexit.register(shutil.rmtree, _state_dir, True)
+
+
+def enabled():
+    return bool(env.get("rolling_restart"))
+
+
+def waves(hosts):
+    """
+    Split `hosts` into the canary wave and the waves after it.
+    """
+
+    canary = max(int(env.get("rolling_canary", 1)), 1)
+    size = max(int(env.get("rolling_wave_size", 1)), 1)
+
+    result = [hosts[:canary]]
+    for i in range(canary, len(hosts), size):
+        result.append(hosts[i:i + size])
+
+    return [wave for wave in result if wave]
+
+
+def wave_index(host_string):
+    for index, wave in enumerate(waves(utils.all_hosts())):
+        if host_string in wave:
+            return index
+
+    return None
+
+
+def mark(host_string, state):
+    if not os.path.exists(_state_dir):
+        try:
+            os.makedirs(_state_dir)
+        except OSError:
+            # Another host's process created it first.
+            pass
+
+    with open(os.path.join(_state_dir, "%s.%s" % (host_string, state)), "w"):
+        pass
+
+
+def marked(host_string, state):
+    return os.path.exists(os.path.join(_state_dir,
+                                       "%s.%s" % (host_string, state)))
+
+
+def skip():
+    """
+    Let later waves go ahead without the current host, which isn't going to
+    be restarted by this run, or whose deploy has finished without it.
+    """
+
+    if enabled():
+        mark(env.host_string, "ready")
+
+
+def fail():
+    """
+    Record that the current host's deploy failed, so that later waves abort
+    rather than wait for it until env.rolling_timeout.
+    """
+
+    if enabled():
+        mark(env.host_string, "failed")
+
+
+def wait_for_turn():
+    """
+    Wait until every host in the waves before the current host's has passed
+    its readiness check. Aborts if one of them failed or env.rolling_timeout
+    seconds pass.
+    """
+
+    index = wave_index(env.host_string)
+    if not index:
+        return
+
+    earlier = sum(waves(utils.all_hosts())[:index], [])
+    deadline = time.time() + float(env.get("rolling_timeout", 1800))
+
+    while True:
+        failed = [h for h in earlier if marked(h, "failed")]
+        if failed:
+            wave_name = "an earlier wave"
+            if failed[0] in waves(utils.all_hosts())[0]:
+                wave_name = "the canary wave"
+            abort("Not restarting, %s failed in %s" % (
+                ", ".join(failed), wave_name))
+
+        waiting = [h for h in earlier if not marked(h, "ready")]
+        if not waiting:
+            return
+
+        if time.time() > deadline:
+            abort("Timed out waiting for %s to restart" % ", ".join(waiting))
+
+        time.sleep(1)
+
+
+def check(url, timeout):
+    """
+    Whether a single readiness check of `url` passes. `tcp://host:port`
+    checks that a connection is accepted, anything else is fetched over HTTP
+    and must not return an error status.
+    """
+
+    parsed = urlparse.urlparse(url)
+
+    try:
+        if parsed.scheme == "tcp":
+            socket.create_connection((parsed.hostname, parsed.port),
+                                     timeout).close()
+        else:
+            urllib2.urlopen(url, timeout=timeout).close()
+    except (socket.error, urllib2.URLError, httplib.HTTPException,
+            ValueError):
+        return False
+
+    return True
+
+
+@tracing.phase("readiness")
+def wait_until_ready():
+    """
+    Poll env.readiness_check for the current host, interpolated with env so
+    that it may contain `%(host)s`, until it passes. Aborts if it doesn't
+    within env.readiness_timeout seconds.
+    """
+
+    if not env.get("readiness_check"):
+        return
+
+    url = env.readiness_check % env
+    interval = float(env.get("readiness_interval", 2))
+    deadline = time.time() + float(env.get("readiness_timeout", 60))
+
+    while not check(url, interval):
+        if time.time() > deadline:
+            abort("%s did not become ready" % url)
+        time.sleep(interval)
+
+    puts("%s is ready" % url)
+
+
+@contextmanager
+def wave():
+    """
+    Context manager around a host's restart which, when env.rolling_restart
+    is set, waits for the host's turn and then waits until the host is ready
+    again. Later waves are released when it is, or aborted if anything fails.
+    """
+
+    if not enabled():
+        yield
+        return
+
+    try:
+        wait_for_turn()
+
+        yield
+        wait_until_ready()
+    except BaseException:
+        fail()
+        raise
+
+    mark(env.host_string, "ready")
+
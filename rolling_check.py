@@ -0,0 +1,234 @@
+"""
+Rolling restart check.
+
+Runs rolling.wave() for a number of fake hosts, each of which is a local
+HTTP server that only starts serving once its host has "restarted", in one
+process per host as Fabric's parallel execution does. Checks that a host
+only restarts once every host in the earlier waves has passed its readiness
+check, and that when the canary fails no other host restarts.
+
+Can be run either as a Fabric task:
+
+    fab -f yellfabric/rolling_check.py rolling_check:hosts=5,wave_size=2
+
+or directly:
+
+    python yellfabric/rolling_check.py --hosts 5 --wave-size 2
+"""
+
+import argparse
+import BaseHTTPServer
+import multiprocessing
+import os
+import shutil
+import SimpleHTTPServer
+import tempfile
+import threading
+import time
+
+from fabric.api import env, puts, abort, hide
+
+import rolling
+
+
+SCENARIOS = [
+    "ordered",
+    "canary_failure",
+]
+
+
+class ReadyHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    """
+    Records the host as ready when it first answers its readiness check,
+    which is before rolling.wave() releases the later waves.
+    """
+
+    def do_GET(self):
+        if not self.server.answered:
+            self.server.answered = True
+            record(self.server.log_file, self.server.host, "ready")
+
+        SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+
+    def log_message(self, *args):
+        pass
+
+
+def record(log_file, host, event):
+    with open(log_file, "a") as f:
+        f.write("%s %s %f\n" % (host, event, time.time()))
+
+
+def events(log_file):
+    """
+    `{(host, event): time}` of the events recorded by the hosts.
+    """
+
+    result = {}
+    if not os.path.exists(log_file):
+        return result
+
+    with open(log_file) as f:
+        for line in f:
+            host, event, when = line.split()
+            result[(host, event)] = float(when)
+
+    return result
+
+
+def restart_host(server, host, workdir, failing, restart_time):
+    """
+    Restart a single fake host within its wave. `failing` hosts never start
+    serving, so that their readiness check times out.
+    """
+
+    log_file = os.path.join(workdir, "events.log")
+    env.host_string = env.host = host
+
+    with hide("everything"):
+        with rolling.wave():
+            record(log_file, host, "restart")
+            time.sleep(restart_time)
+            if not failing:
+                server.log_file = log_file
+                server.host = host
+                server.answered = False
+                thread = threading.Thread(target=server.serve_forever)
+                thread.daemon = True
+                thread.start()
+
+
+def _run_in_child(server, host, workdir, failing, restart_time):
+    os.chdir(workdir)
+    try:
+        restart_host(server, host, workdir, failing, restart_time)
+    except BaseException:
+        os._exit(1)
+    os._exit(0)
+
+
+def run_scenario(scenario, hosts, canary, wave_size, restart_time):
+    """
+    Run one scenario and return a list of the problems found with it.
+    """
+
+    workdir = tempfile.mkdtemp(prefix="yellfabric-rolling-")
+    servers = []
+
+    try:
+        # Bound up front so that each port is listening, and the readiness
+        # check times out rather than being refused, until its host serves.
+        for i in range(hosts):
+            servers.append(BaseHTTPServer.HTTPServer(("127.0.0.1", 0),
+                                                     ReadyHandler))
+        host_strings = ["127.0.0.1:%d" % s.server_address[1] for s in servers]
+
+        env.hosts = env.all_hosts = host_strings
+        env.rolling_restart = True
+        env.rolling_canary = canary
+        env.rolling_wave_size = wave_size
+        env.rolling_timeout = 60
+        env.readiness_check = "http://%(host_string)s/"
+        env.readiness_interval = 0.2
+        env.readiness_timeout = restart_time + 2
+        rolling._state_dir = os.path.join(workdir, "state")
+
+        failing = set()
+        if scenario == "canary_failure":
+            failing.add(host_strings[0])
+
+        children = {}
+        for server, host in zip(servers, host_strings):
+            children[host] = multiprocessing.Process(
+                target=_run_in_child,
+                args=(server, host, workdir, host in failing, restart_time))
+            children[host].start()
+
+        for child in children.values():
+            child.join()
+
+        log = events(os.path.join(workdir, "events.log"))
+    finally:
+        for server in servers:
+            server.server_close()
+        shutil.rmtree(workdir)
+
+    problems = []
+    waves = rolling.waves(host_strings)
+
+    if scenario == "ordered":
+        for index, wave in enumerate(waves):
+            for host in wave:
+                if children[host].exitcode != 0:
+                    problems.append("%s failed" % host)
+                    continue
+
+                for earlier in sum(waves[:index], []):
+                    if log[(host, "restart")] < log[(earlier, "ready")]:
+                        problems.append("%s restarted before %s was ready"
+                                        % (host, earlier))
+
+    elif scenario == "canary_failure":
+        # The rest of the canary wave restarts alongside the failing host.
+        for host in host_strings:
+            if host in waves[0] and host not in failing:
+                continue
+            if children[host].exitcode == 0:
+                problems.append("%s didn't abort" % host)
+            if (host, "restart") in log and host not in failing:
+                problems.append("%s restarted after the canary failed"
+                                % host)
+
+    return problems
+
+
+def rolling_check(hosts=5, canary=1, wave_size=2, restart_time=0.5,
+                  scenarios=None):
+    """
+    Check the ordering of rolling restarts against local HTTP servers.
+
+        - hosts: Number of fake hosts to restart.
+        - canary: Number of hosts in the canary wave.
+        - wave_size: Number of hosts in each wave after the canary.
+        - restart_time: Seconds that each host takes to restart.
+        - scenarios: Comma separated subset of scenarios to run.
+    """
+
+    if scenarios:
+        scenarios = scenarios.split(",")
+        for scenario in scenarios:
+            if scenario not in SCENARIOS:
+                abort("Unknown scenario %r" % scenario)
+    else:
+        scenarios = SCENARIOS
+
+    failed = []
+    for scenario in scenarios:
+        problems = run_scenario(scenario, int(hosts), int(canary),
+                                int(wave_size), float(restart_time))
+        puts("%-16s %s" % (scenario, "ok" if not problems else "FAILED"))
+        for problem in problems:
+            puts("    %s" % problem)
+        if problems:
+            failed.append(scenario)
+
+    if failed:
+        abort("Failed: %s" % ", ".join(failed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--hosts", type=int, default=5)
+    parser.add_argument("--canary", type=int, default=1)
+    parser.add_argument("--wave-size", type=int, default=2)
+    parser.add_argument("--restart-time", type=float, default=0.5)
+    parser.add_argument("--scenarios", default=None,
+                        help="Comma separated subset of: %s" % ", ".join(SCENARIOS))
+    args = parser.parse_args()
+
+    rolling_check(args.hosts, args.canary, args.wave_size, args.restart_time,
+                  args.scenarios)
+
+
+if __name__ == "__main__":
+    main()
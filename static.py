@@ -1,5 +1,10 @@
 import os
+import re
+import sys
+import facts
+import journal
 import utils
+import tracing
 import operations
 
 from fabric.api import env, runs_once, require, run, local
@@ -14,12 +19,25 @@ def setup_paths():
     env.config_source = "index.html.template"
     env.config_target = "index.html"
 
+@journal.resumable
 def deploy_static(ref=None, dirty=False):
     """
     Deploy static files to a vhost.
     """
+    if facts.skip_current_host(ref, dirty):
+        return
+
     build_cmd = create_custom_command(env.require_path, env.build_config)
     operations.fetch_render_copy(ref, False, dirty, True, build_cmd)
+    facts.mark_deployed(ref, dirty)
+
+def rollback_static(release=None):
+    """
+    Switch the vhost back to the previous release, or to `release`.
+    Requires env.releases.
+    """
+
+    operations.rollback_release(release)
 
 def create_custom_command(require_path, build_conf_path):
     """
@@ -29,4 +47,31 @@ def create_custom_command(require_path, build_conf_path):
         abs_require_path = os.path.join(tempdir, require_path)
         abs_build_conf_path = os.path.join(tempdir, build_conf_path)
         local("node %s -o %s" % (abs_require_path, abs_build_conf_path))
+
+    def cache_paths(tempdir):
+        """
+        The `dir` that r.js writes to, which is relative to the build config.
+        Returns None, so that nothing is cached, if it isn't set or is
+        outside of the checkout.
+        """
+
+        with open(os.path.join(tempdir, build_conf_path)) as build_conf:
+            match = re.search(r"""\bdir\s*:\s*["']([^"']+)["']""", build_conf.read())
+
+        if not match:
+            return None
+
+        path = os.path.normpath(os.path.join(os.path.dirname(build_conf_path), match.group(1)))
+        if os.path.isabs(path) or path.startswith(".."):
+            return None
+
+        return [path]
+
+    # Allow the outputs to be reused by operations.fetch_render_copy() when
+    # env.build_cache is enabled.
+    build_local_cmd.cache_key = "node %s -o %s" % (require_path, build_conf_path)
+    build_local_cmd.cache_paths = cache_paths
     return build_local_cmd
+
+
+tracing.instrument(sys.modules[__name__])
@@ -0,0 +1,274 @@
+"""
+Span tracing of deploys.
+
+When `env.trace_file` is set every local command, remote run/sudo/put,
+rsync and template render is recorded as a span, tagged with the host and
+the deploy phase it belongs to. At exit the spans are written to
+`env.trace_file` in Chrome's trace event format, which can be loaded into
+chrome://tracing or Perfetto, and a per-phase summary table is printed.
+
+Modules opt in by calling instrument() on themselves, which wraps their
+references to Fabric's operations, and by marking phases with phase().
+"""
+
+import atexit
+import functools
+import json
+import threading
+import time
+
+from fabric.api import env, puts
+
+
+_spans = []
+_lock = threading.Lock()
+_state = threading.local()
+
+TRACED_OPERATIONS = ("local", "run", "sudo", "put", "get")
+
+
+def enabled():
+    return bool(env.get("trace_file"))
+
+
+def current_phase():
+    stack = getattr(_state, "phases", None)
+    if stack:
+        return stack[-1]
+
+    return "other"
+
+
+def record(name, category, start, end, host=None, phase=None):
+    """
+    Record a finished span. Times are from time.time().
+    """
+
+    if host is None:
+        host = env.get("host_string") or "localhost"
+
+    with _lock:
+        if not _spans:
+            atexit.register(write_trace)
+        _spans.append({
+            "name": name,
+            "cat": category,
+            "host": host,
+            "phase": phase or current_phase(),
+            "start": start,
+            "end": end,
+        })
+
+
+class span(object):
+    """
+    Context manager which records the enclosed block as a span.
+    """
+
+    def __init__(self, name, category, host=None, phase=None):
+        self.name = name
+        self.category = category
+        self.host = host
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        if enabled():
+            record(self.name, self.category, self.start, time.time(),
+                   self.host, self.phase)
+
+
+class phase(object):
+    """
+    Mark the enclosed block, or every call of the decorated function, as
+    belonging to a deploy phase. Phases nest, and spans are tagged with the
+    innermost one. The phase itself is also recorded as a span.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        if not hasattr(_state, "phases"):
+            _state.phases = []
+        _state.phases.append(self.name)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        _state.phases.pop()
+        if enabled():
+            record(self.name, "phase", self.start, time.time(),
+                   phase=self.name)
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with phase(self.name):
+                return func(*args, **kwargs)
+        return wrapper
+
+
+def traced(category):
+    """
+    Decorator which records each call of a function as a span, named after
+    the function and its first argument.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled():
+                return func(*args, **kwargs)
+
+            name = func.__name__
+            if args:
+                name = "%s %s" % (name, args[0])
+
+            with span(name, category):
+                return func(*args, **kwargs)
+
+        wrapper.traced = True
+        return wrapper
+
+    return decorator
+
+
+def _traced_operation(category, func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not enabled():
+            return func(*args, **kwargs)
+
+        name = "%s" % (args[0] if args else kwargs.get("command", category))
+        if name.startswith("rsync "):
+            span_category = "rsync"
+        else:
+            span_category = category
+
+        with span(name, span_category):
+            return func(*args, **kwargs)
+
+    wrapper.traced = True
+    return wrapper
+
+
+def instrument(module):
+    """
+    Wrap the module's references to Fabric's local, run, sudo, put and get
+    so that they are recorded as spans.
+
+    Fabric only leaves its own functions out of a fabfile's tasks, so the
+    wrappers are also left out of `from module import *` by giving the
+    module an `__all__`, unless it already has one.
+    """
+
+    for name in TRACED_OPERATIONS:
+        func = module.__dict__.get(name)
+        if func is not None and not getattr(func, "traced", False):
+            setattr(module, name, _traced_operation(name, func))
+
+    if not hasattr(module, "__all__"):
+        module.__all__ = [name for name in module.__dict__
+                          if not name.startswith("_")
+                          and name not in TRACED_OPERATIONS]
+
+
+def write_trace():
+    """
+    Write the recorded spans to env.trace_file and print a summary.
+    """
+
+    if not enabled() or not _spans:
+        return
+
+    with _lock:
+        spans = list(_spans)
+
+    origin = min([s["start"] for s in spans])
+    hosts = sorted(set([s["host"] for s in spans]))
+
+    # One row per host in the trace viewer.
+    events = []
+    for tid, host in enumerate(hosts):
+        events.append({"name": "thread_name", "ph": "M", "pid": 1,
+                       "tid": tid, "args": {"name": host}})
+
+    for s in spans:
+        events.append({
+            "name": s["name"],
+            "cat": s["cat"],
+            "ph": "X",
+            "pid": 1,
+            "tid": hosts.index(s["host"]),
+            "ts": int((s["start"] - origin) * 1e6),
+            "dur": int((s["end"] - s["start"]) * 1e6),
+            "args": {"host": s["host"], "phase": s["phase"]},
+        })
+
+    with open(env.trace_file, "w") as trace_file:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"},
+                  trace_file)
+
+    puts("Wrote %d spans to %s" % (len(spans), env.trace_file))
+    for line in summary(spans):
+        puts(line, show_prefix=False)
+
+
+def phase_totals(spans):
+    """
+    Return `{phase: (count, total, longest)}` of the number of times each
+    phase ran and its total and longest time in seconds. Time outside of any
+    phase is reported as "other". Nested phases are included in the time of
+    their parents.
+    """
+
+    totals = {}
+    for s in spans:
+        if s["cat"] == "phase":
+            name = s["name"]
+        elif s["phase"] == "other":
+            name = "other"
+        else:
+            continue
+
+        count, total, longest = totals.get(name, (0, 0.0, 0.0))
+        duration = s["end"] - s["start"]
+        totals[name] = (count + 1, total + duration, max(longest, duration))
+
+    return totals
+
+
+def summary(spans):
+    """
+    Lines of a table of phase_totals(), slowest first.
+    """
+
+    lines = ["%-24s %8s %10s %10s" % ("phase", "count", "total (s)", "max (s)")]
+    for name, (count, total, longest) in sorted(
+            phase_totals(spans).iteritems(), key=lambda item: -item[1][1]):
+        lines.append("%-24s %8d %10.2f %10.2f" % (name, count, total, longest))
+
+    return lines
+
+
+def extend(spans):
+    """
+    Add spans recorded by another process, such as a forked pipeline step.
+    """
+
+    for s in spans:
+        record(s["name"], s["cat"], s["start"], s["end"], s["host"],
+               s["phase"])
+
+
+def recorded_spans():
+    """
+    A copy of the spans recorded so far.
+    """
+
+    with _lock:
+        return list(_spans)
@@ -6,17 +6,34 @@ directly.
 """
 
 import context_managers
+import tracing
 
 import os
+import atexit
+import pipes
+import base64
+import copy
+import fnmatch
+import hashlib
 import shutil
+import subprocess
+import sys
+import tarfile
 import tempfile
+import threading
+import time
 import json
+import Queue
+
+from cStringIO import StringIO
 
 from string import replace, Template
+from multiprocessing.pool import ThreadPool
 from xml.dom import minidom
 
-from fabric.api import env, prompt, runs_once, sudo, local, puts, lcd, abort
-from fabric.context_managers import hide, cd, prefix
+from fabric.api import env, prompt, runs_once, sudo, run, put, get, local, puts, lcd, abort
+from fabric.context_managers import hide, cd, prefix, settings
+from fabric.network import normalize
 #from fabric.contrib.files import append
 
 
@@ -38,7 +55,38 @@ def django_manage_run(virtualenv, path, command, user, interactive=False):
         cmd = "%s --noinput" % cmd
 
     with context_managers.virtualenv(virtualenv):
-        sudo(cmd, user=user)
+        return sudo(cmd, user=user)
+
+
+def django_manage_batch(virtualenv, path, commands, user):
+    """
+    Run several Django management commands in a single Python process, so
+    that Django is only started once. Aborts at the first failure.
+
+        - virtualenv: Absolute path of Python virtualenv.
+        - path: Absolute path of Django project.
+        - commands: List of argument lists, e.g. [["migrate", "app"]].
+        - user: User to sudo as.
+    """
+
+    manage_py = os.path.join(path, "manage.py")
+
+    # `shell` reads the script from stdin and always exits zero, so the exit
+    # status is derived from whether every command returned. sys.exit()
+    # rather than os._exit(), so that buffered output isn't lost.
+    script = "\n".join([
+        "import sys",
+        "from django.core.management import ManagementUtility",
+        "done = [ManagementUtility([%r] + argv).execute() for argv in %r]"
+            % (manage_py, commands),
+        "sys.exit(0 if 'done' in dir() else 1)",
+        "",
+    ])
+    cmd = "echo %s | base64 -d | python %s shell --plain" % (
+        base64.b64encode(script), manage_py)
+
+    with context_managers.virtualenv(virtualenv):
+        return sudo(cmd, user=user)
 
 
 def play_run(path, command, user):
@@ -130,6 +178,10 @@ def scm_get_info(scm_type, scm_ref=None, directory=False):
                     "git describe --always",
                     capture=True,
                 )
+                commit = local(
+                    "git rev-parse HEAD",
+                    capture=True,
+                )
                 repo = local(
                     "git remote -v | grep fetch",
                     capture=True,
@@ -137,6 +189,7 @@ def scm_get_info(scm_type, scm_ref=None, directory=False):
                 scm_info = {
                     "type": scm_type,
                     "rev": revision,
+                    "commit": commit,
                     "url": repo,
                     "branch": scm_ref,
                 }
@@ -154,20 +207,49 @@ def fetch_source(scm_type, scm_url, scm_ref=None, dirty=False):
         if not scm_ref:
             scm_ref = scm_get_ref(scm_type)
 
-        if scm_type.lower() == "svn":
-            local(
-                "svn checkout --quiet --config-option " \
-                    "config:miscellany:use-commit-times=yes %s/%s %s"
-                    % (
-                        env.scm_url,
-                        scm_ref,
-                        tempdir,
-                    ),
-            )
-        elif scm_type.lower() == "git":
-            # should only pull latest revision off a tag/branch
-            git_branch = scm_ref if scm_ref else 'master'
-            local("git clone --depth 1 --branch %s %s %s" % (git_branch, env.scm_url, tempdir))
+        # Only fetch the subtree that will be deployed when there is one.
+        sparse_path = env.get("scm_path")
+
+        # Hold the cache while updating, cloning from and pruning it, since
+        # other fab runs may share it.
+        scm_cache = env.get("scm_cache") and os.path.expanduser(env.scm_cache)
+        with context_managers.cache_lock(scm_cache):
+            if scm_type.lower() == "svn":
+                svn_url = "%s/%s" % (env.scm_url, scm_ref)
+                if env.get("scm_cache"):
+                    working_copy = scm_cache_svn(svn_url, sparse_path)
+                    local("cp -a %s/. %s" % (working_copy, tempdir))
+                else:
+                    svn_checkout(svn_url, tempdir, sparse_path)
+            elif scm_type.lower() == "git":
+                # should only pull latest revision off a tag/branch
+                git_branch = scm_ref if scm_ref else 'master'
+                if env.get("scm_cache"):
+                    source = scm_cache_git()
+                    # Not --shared, so that the checkout doesn't depend on the
+                    # mirror, which may be pruned while the checkout is in use.
+                    clone_opts = "--quiet"
+                else:
+                    source = env.scm_url
+                    clone_opts = "--depth 1"
+                    if sparse_path and env.get("scm_partial_clone"):
+                        clone_opts += " --filter=blob:none"
+
+                if sparse_path:
+                    clone_opts += " --no-checkout"
+
+                local("git clone %s --branch %s %s %s" % (clone_opts, git_branch, source, tempdir))
+
+                with lcd(tempdir):
+                    if env.get("scm_cache"):
+                        # Report the real origin in the version file, not the cache.
+                        local("git remote set-url origin %s" % env.scm_url)
+                    if sparse_path:
+                        git_sparse_checkout(tempdir, sparse_path)
+
+            if env.get("scm_cache"):
+                prune_cache(os.path.expanduser(env.scm_cache),
+                            env.get("scm_cache_max_size"))
 
     #
     # Write out the version info
@@ -189,16 +271,656 @@ def fetch_source(scm_type, scm_url, scm_ref=None, dirty=False):
     return tempdir
 
 
+def scm_cache_path(suffix):
+    """
+    Return the path of the env.scm_cache entry for env.scm_url, marking it as
+    recently used for the purposes of prune_cache().
+    """
+
+    cache_dir = os.path.expanduser(env.scm_cache)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    key = hashlib.sha1(env.scm_url).hexdigest()
+    path = os.path.join(cache_dir, "%s%s" % (key, suffix))
+
+    if os.path.exists(path):
+        os.utime(path, None)
+
+    return path
+
+
+def scm_cache_git():
+    """
+    Create or incrementally update a bare mirror of env.scm_url in
+    env.scm_cache and return its path.
+    """
+
+    mirror = scm_cache_path(".git")
+
+    if os.path.exists(mirror):
+        local("git --git-dir=%s fetch --quiet --prune origin" % mirror)
+    else:
+        local("git clone --quiet --mirror %s %s" % (env.scm_url, mirror))
+
+    return mirror
+
+
+def scm_cache_svn(svn_url, sparse_path=None):
+    """
+    Create or update a working copy of env.scm_url in env.scm_cache, switched
+    to `svn_url`, and return its path.
+    """
+
+    working_copy = scm_cache_path(".svn")
+
+    if os.path.exists(working_copy):
+        local("svn switch --quiet %s %s" % (svn_url, working_copy))
+        if sparse_path:
+            local("svn update --quiet --parents --set-depth infinity %s"
+                  % os.path.join(working_copy, sparse_path))
+    else:
+        svn_checkout(svn_url, working_copy, sparse_path)
+
+    return working_copy
+
+
+def svn_checkout(svn_url, directory, sparse_path=None):
+    """
+    Checkout `svn_url` into `directory`. If `sparse_path` is given then only
+    that subtree is populated, while the root remains a working copy so that
+    scm_get_info() still reports the URL and revision of the whole project.
+    """
+
+    opts = "--quiet --config-option config:miscellany:use-commit-times=yes"
+
+    if not sparse_path:
+        local("svn checkout %s %s %s" % (opts, svn_url, directory))
+        return
+
+    local("svn checkout %s --depth empty %s %s" % (opts, svn_url, directory))
+    local("svn update %s --parents --set-depth infinity %s"
+          % (opts, os.path.join(directory, sparse_path)))
+
+
+def git_sparse_checkout(directory, sparse_path):
+    """
+    Populate the working tree of a `--no-checkout` clone in `directory` with
+    only the `sparse_path` subtree. Must be called from within `lcd()` of
+    that directory.
+    """
+
+    local("git config core.sparseCheckout true")
+
+    with open(os.path.join(directory, ".git", "info", "sparse-checkout"), "w") as f:
+        f.write("/%s/\n" % sparse_path.strip("/"))
+
+    local("git read-tree -mu HEAD")
+
+
+def cache_entry_size(path):
+    """
+    Total size in bytes of a file or directory tree.
+    """
+
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            filename = os.path.join(root, name)
+            if not os.path.islink(filename):
+                size += os.path.getsize(filename)
+
+    return size
+
+
+def prune_cache(cache_dir, max_size):
+    """
+    Evict the least recently used entries of `cache_dir` until its total
+    size is no more than `max_size` megabytes. Entries are the immediate
+    children of `cache_dir` and recency is their mtime. Does nothing if
+    `max_size` is None.
+    """
+
+    if max_size is None or not os.path.isdir(cache_dir):
+        return
+
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        entries.append((os.path.getmtime(path), cache_entry_size(path), path))
+
+    entries.sort()
+    total = sum([entry[1] for entry in entries])
+    limit = int(max_size) * 1024 * 1024
+
+    # Never evict the most recently used entry, which is in use right now.
+    for mtime, size, path in entries[:-1]:
+        if total <= limit:
+            break
+
+        puts("Evicting %s from cache" % path)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+        total -= size
+
+
+def version_file_path(tempdir):
+    """
+    Return the path of the version file written by fetch_source(), which is
+    at the root of the checkout rather than in env.scm_path.
+    """
+
+    if "scm_path" in env:
+        tempdir = os.path.normpath(
+            os.path.join(tempdir, os.path.relpath("/", "/" + env.scm_path)))
+
+    return os.path.join(tempdir, "version")
+
+
+def build_cache_key(tempdir, build_local_cmd, inputs):
+    """
+    Compute the env.build_cache key of a build from the source version, the
+    build command and the contents of the rendered `inputs`, relative to
+    `tempdir`. Returns None if the build can't be cached, either because
+    env.build_cache isn't set or the command doesn't declare a `cache_key`
+    and the `cache_paths` of its outputs.
+    """
+
+    if not env.get("build_cache"):
+        return None
+
+    if not getattr(build_local_cmd, "cache_key", None) or \
+            not build_cache_paths(tempdir, build_local_cmd):
+        return None
+
+    digest = hashlib.sha1()
+    digest.update(build_local_cmd.cache_key)
+
+    with open(version_file_path(tempdir)) as version_file:
+        digest.update(version_file.read())
+
+    for path in sorted(inputs):
+        digest.update(path)
+        with open(os.path.join(tempdir, path)) as input_file:
+            digest.update(input_file.read())
+
+    return digest.hexdigest()
+
+
+def build_cache_paths(tempdir, build_local_cmd):
+    """
+    The outputs of `build_local_cmd` to cache, relative to `tempdir`. Its
+    `cache_paths` is either a list or a function of `tempdir` returning
+    one, which may return None when the outputs can't be determined.
+    """
+
+    paths = getattr(build_local_cmd, "cache_paths", None)
+    if callable(paths):
+        paths = paths(tempdir)
+
+    return paths
+
+
+def build_cache_restore(tempdir, key):
+    """
+    Copy the cached outputs of build `key` into `tempdir`. Returns False if
+    there is no such entry in env.build_cache.
+    """
+
+    entry = os.path.join(os.path.expanduser(env.build_cache), key)
+
+    if not os.path.isdir(entry):
+        return False
+
+    puts("Restoring build outputs from %s" % entry)
+    os.utime(entry, None)
+    local("cp -a %s/. %s" % (entry, tempdir))
+
+    return True
+
+
+def build_cache_store(tempdir, key, paths):
+    """
+    Store `paths`, relative to `tempdir`, as the outputs of build `key` in
+    env.build_cache and prune it to env.build_cache_max_size.
+    """
+
+    cache_dir = os.path.expanduser(env.build_cache)
+    entry = os.path.join(cache_dir, key)
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    # Unique, so that concurrent runs storing the same key don't collide.
+    partial = tempfile.mkdtemp(prefix="%s.partial-" % key, dir=cache_dir)
+    # Restoring copies the entry's mode onto the checkout's root.
+    os.chmod(partial, 0755)
+
+    for path in paths:
+        target = os.path.normpath(os.path.join(partial, path))
+        if not os.path.exists(target):
+            os.makedirs(target)
+        local("cp -a %s/. %s" % (os.path.join(tempdir, path), target))
+
+    # Only complete entries are ever visible to build_cache_restore().
+    try:
+        os.rename(partial, entry)
+    except OSError:
+        if not os.path.isdir(entry):
+            raise
+
+        # Another run stored the same build first.
+        shutil.rmtree(partial)
+
+    prune_cache(cache_dir, env.get("build_cache_max_size"))
+
+
+def all_hosts():
+    """
+    Every host of the current run, including those given by roles, as
+    Fabric resolved them. Falls back to env.hosts outside of a task.
+    """
+
+    return env.get("all_hosts") or env.hosts
+
+
 def delete_source_conditional(tempdir, dirty=False):
     if dirty:
         return
 
-    if env.host != env.hosts[-1]:
+    if env.host_string != all_hosts()[-1]:
         return
 
     shutil.rmtree(tempdir)
 
 
+def rsync_command(host_string, local_dir, remote_dir, exclude=(),
+                  delete=False, extra_opts=""):
+    """
+    Build an rsync(1) command line equivalent to the one that Fabric's
+    rsync_project() would run, but for an arbitrary host string. This allows
+    transfers to be run outside of Fabric's serial per-host loop.
+    """
+
+    user, host, port = normalize(host_string)
+
+    options = ["-pthrvz"]
+    if delete:
+        options.insert(0, "--delete")
+    for pattern in exclude:
+        options.append('--exclude "%s"' % str(pattern).replace('"', '\\"'))
+    if extra_opts:
+        options.append(extra_opts)
+
+    rsh = ["ssh", "-p %s" % port]
+    keys = env.get("key_filename") or []
+    if isinstance(keys, basestring):
+        keys = [keys]
+    for key in keys:
+        rsh.append("-i %s" % key)
+    rsh.extend(ssh_control_opts(user, host, port))
+    options.append("--rsh='%s'" % " ".join(rsh))
+
+    # Square brackets are mandatory for IPv6 addresses.
+    if host.count(":") > 1:
+        host = "[%s]" % host
+
+    return "rsync %s %s %s@%s:%s" % (
+        " ".join(options), local_dir, user, host, remote_dir)
+
+
+_ssh_control_paths = set()
+_ssh_control_lock = threading.Lock()
+
+
+def ssh_control_opts(user, host, port):
+    """
+    Return ssh(1) options which share a single multiplexed control
+    connection per host between every rsync of the run, so that only the
+    first pays for the SSH handshake. The connection is kept open for the
+    rest of the run and closed when Fabric exits.
+
+    Returns no options unless env.ssh_control_dir is set.
+    """
+
+    if not env.get("ssh_control_dir"):
+        return []
+
+    control_dir = os.path.expanduser(env.ssh_control_dir)
+    destination = "%s@%s" % (user, host)
+
+    # Hash the destination to stay within the UNIX socket path length limit.
+    control_path = os.path.join(control_dir, hashlib.sha1(
+        "%s:%s" % (destination, port)).hexdigest()[:16])
+
+    with _ssh_control_lock:
+        if control_path not in _ssh_control_paths:
+            if not os.path.exists(control_dir):
+                os.makedirs(control_dir, 0700)
+            _ssh_control_paths.add(control_path)
+            atexit.register(subprocess.call,
+                            ["ssh", "-q", "-O", "exit", "-o",
+                             "ControlPath=%s" % control_path, destination],
+                            stderr=open(os.devnull, "w"))
+
+    return [
+        "-o ControlMaster=auto",
+        "-o ControlPath=%s" % control_path,
+        "-o ControlPersist=%s" % env.get("ssh_control_persist", 600),
+    ]
+
+
+def rsync_project(remote_dir, local_dir, exclude=(), delete=False,
+                  extra_opts=""):
+    """
+    Drop-in replacement for Fabric's rsync_project() for the current host,
+    which builds its command with rsync_command() so that it shares the
+    multiplexed SSH connection from ssh_control_opts().
+    """
+
+    return local(rsync_command(env.host_string, local_dir, remote_dir,
+                               exclude, delete, extra_opts or ""))
+
+
+MANIFEST_NAME = ".yellfabric-manifest"
+MANIFEST_HEADER = "# yellfabric manifest 2"
+
+
+def rsync_excluded(path, exclude):
+    """
+    Whether rsync would skip the relative `path` because of one of the
+    `exclude` patterns. Patterns with a leading slash are anchored to the
+    root, other patterns containing a slash match the end of the path and
+    the rest match any of its components.
+    """
+
+    parts = path.split("/")
+    for pattern in exclude:
+        if pattern.startswith("/"):
+            if fnmatch.fnmatch(path, pattern[1:]):
+                return True
+        elif "/" in pattern:
+            if fnmatch.fnmatch(path, pattern) or \
+                    fnmatch.fnmatch(path, "*/" + pattern):
+                return True
+        elif any([fnmatch.fnmatch(part, pattern) for part in parts]):
+            return True
+
+    return False
+
+
+@tracing.traced("manifest")
+def write_manifest(local_dir, exclude=()):
+    """
+    Write a manifest of the files and symlinks in `local_dir` that rsync
+    would consider to MANIFEST_NAME in its root, one `<sha1> <size> <mode>
+    <path>` line per entry, and return it as a dictionary of
+    `{path: (sha1, size, mode)}`. The mode is the octal st_mode, so that
+    permission and type changes are noticed, and for symlinks, including
+    symlinked directories, the checksum and size are those of the target.
+    """
+
+    manifest = {}
+    for root, dirs, files in os.walk(local_dir):
+        # os.walk() doesn't descend into symlinked directories.
+        links = [name for name in dirs if os.path.islink(os.path.join(root, name))]
+
+        for name in files + links:
+            filename = os.path.join(root, name)
+            path = os.path.relpath(filename, local_dir)
+
+            if path == MANIFEST_NAME or rsync_excluded(path, exclude):
+                continue
+
+            mode = os.lstat(filename).st_mode
+            if os.path.islink(filename):
+                target = os.readlink(filename)
+                manifest[path] = (hashlib.sha1(target).hexdigest(),
+                                  len(target), mode)
+            else:
+                manifest[path] = (file_checksum(filename),
+                                  os.path.getsize(filename), mode)
+
+    with open(os.path.join(local_dir, MANIFEST_NAME), "w") as f:
+        f.write("%s\n" % MANIFEST_HEADER)
+        for path in sorted(manifest):
+            f.write("%s %d %o %s\n" % (manifest[path] + (path,)))
+
+    return manifest
+
+
+def read_remote_manifest(remote_dir):
+    """
+    The manifest left in `remote_dir` on the current host by the last deploy,
+    or None if there isn't a readable one in the current format.
+    """
+
+    buf = StringIO()
+    with settings(hide("running", "warnings"), warn_only=True):
+        result = get(os.path.join(remote_dir, MANIFEST_NAME), buf)
+
+    if result.failed:
+        return None
+
+    lines = buf.getvalue().splitlines()
+    if not lines or lines[0] != MANIFEST_HEADER:
+        return None
+
+    manifest = {}
+    for line in lines[1:]:
+        try:
+            digest, size, mode, path = line.split(" ", 3)
+            manifest[path] = (digest, int(size), int(mode, 8))
+        except ValueError:
+            return None
+
+    return manifest
+
+
+def manifest_changes(local, remote):
+    """
+    Return the sorted paths that differ between two manifests, either
+    because their content, symlink target or mode changed or because they
+    were added or deleted.
+    """
+
+    changed = [path for path, entry in local.iteritems()
+               if remote.get(path) != entry]
+    deleted = [path for path in remote if path not in local]
+
+    return sorted(changed + deleted)
+
+
+@runs_once
+def release_name():
+    """
+    Name of the release directory created by this run. It is the same for
+    every host, and sorts in the order that releases were made.
+    """
+
+    return time.strftime("%Y%m%d%H%M%S", time.gmtime())
+
+
+def releases_path(project_path):
+    """
+    Directory that holds the releases of a project whose live tree is the
+    symlink `project_path`.
+    """
+
+    return "%s.releases" % project_path.rstrip("/")
+
+
+def list_releases(project_path, user):
+    """
+    Names of the releases of a project on the current host, oldest first.
+    """
+
+    with settings(hide("running", "stdout", "warnings"), warn_only=True):
+        out = sudo("ls -1 %s" % releases_path(project_path), user=user)
+
+    if out.failed:
+        return []
+
+    return sorted(out.split())
+
+
+def current_release(project_path, user):
+    """
+    Name of the release that `project_path` points at, or None if it isn't a
+    symlink into the releases directory.
+    """
+
+    with settings(hide("running", "stdout", "warnings"), warn_only=True):
+        out = sudo("readlink %s" % project_path.rstrip("/"), user=user)
+
+    target = out.strip()
+    if out.failed or os.path.dirname(target) != releases_path(project_path):
+        return None
+
+    return os.path.basename(target)
+
+
+def activate_release(project_path, name, user):
+    """
+    Atomically point the symlink `project_path` at the release `name`.
+
+    A `project_path` which is still a plain directory, from before releases
+    were used, is first moved into the releases directory as a release named
+    after its mtime, so that it can be rolled back to.
+    """
+
+    link = project_path.rstrip("/")
+    releases = releases_path(project_path)
+
+    sudo("if [ -d %(link)s ] && [ ! -L %(link)s ]; then "
+         "mkdir -p %(releases)s && "
+         "mv %(link)s %(releases)s/$(date -u -r %(link)s +%%Y%%m%%d%%H%%M%%S); "
+         "fi && "
+         "ln -sfn %(target)s %(link)s.tmp && mv -T %(link)s.tmp %(link)s" % {
+             "link": link,
+             "releases": releases,
+             "target": os.path.join(releases, name),
+         }, user=user)
+
+
+def rollback_target(project_path, release, user):
+    """
+    Return the live release and the one to roll back to, as
+    `(current, release)`. That is `release` if given, and otherwise the one
+    before the live release. Aborts if there isn't one.
+    """
+
+    releases = list_releases(project_path, user)
+    current = current_release(project_path, user)
+
+    if current is None:
+        abort("%s is not a release, nothing to roll back" % project_path)
+
+    if release is None:
+        older = [r for r in releases if r < current]
+        if not older:
+            abort("No release older than %s to roll back to" % current)
+        release = older[-1]
+    elif release not in releases:
+        abort("Release %r not found in %s" % (
+            release, releases_path(project_path)))
+
+    return current, release
+
+
+def carry_excluded(project_path, name, exclude, user):
+    """
+    Hardlink the paths matched by the rsync `exclude` patterns, such as
+    uploaded media, from the live tree into the release `name`. They are
+    never transferred, so the release would otherwise start without them.
+    """
+
+    live = project_path.rstrip("/")
+
+    # The same patterns as the transfer, so that rsync decides what matches.
+    filters = ["+ */"]
+    for pattern in exclude:
+        filters.extend(["+ %s" % pattern, "+ %s/***" % pattern.rstrip("/")])
+    filters.append("- *")
+
+    sudo("if [ -d %(live)s ]; then "
+         "rsync -a --prune-empty-dirs --link-dest=%(live)s/ %(filters)s %(live)s/ %(target)s/; "
+         "fi" % {
+             "live": live,
+             "target": os.path.join(releases_path(project_path), name),
+             "filters": " ".join(["--filter=%s" % pipes.quote(rule) for rule in filters]),
+         }, user=user)
+
+
+def prune_releases(project_path, keep, user):
+    """
+    Remove all but the newest `keep` releases, never removing the release
+    that is currently live.
+    """
+
+    current = current_release(project_path, user)
+    releases = list_releases(project_path, user)
+
+    old = [r for r in releases[:-keep] if r != current] if keep > 0 else []
+    if old:
+        with cd(releases_path(project_path)):
+            sudo("rm -rf %s" % " ".join(old), user=user)
+
+
+def local_parallel(commands, pool_size=10):
+    """
+    Run a dictionary of `{host_string: command}` local shell commands
+    concurrently, at most `pool_size` at a time.
+
+    Output for each command is buffered and printed, prefixed with the host
+    string, once that command has finished so that hosts don't interleave.
+    Returns a dictionary of `{host_string: return_code}`.
+    """
+
+    queue = Queue.Queue()
+    for item in commands.iteritems():
+        queue.put(item)
+
+    results = {}
+    lock = threading.Lock()
+    phase = tracing.current_phase()
+
+    def worker():
+        while True:
+            try:
+                host_string, cmd = queue.get_nowait()
+            except Queue.Empty:
+                return
+
+            with tracing.span(cmd, "rsync" if cmd.startswith("rsync ") else "local",
+                              host=host_string, phase=phase):
+                proc = subprocess.Popen(cmd, shell=True,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT)
+                output = proc.communicate()[0]
+
+            with lock:
+                results[host_string] = proc.returncode
+                puts("[%s] local: %s" % (host_string, cmd), show_prefix=False)
+                for line in output.splitlines():
+                    puts("[%s] out: %s" % (host_string, line),
+                         show_prefix=False)
+
+    threads = [threading.Thread(target=worker)
+               for i in range(min(int(pool_size), len(commands)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return results
+
+
 def render_settings_template(source, target, settings, debug):
     """
     Render a settings file from a template in a local checkout.
@@ -262,6 +984,7 @@ def template_context(var_names):
     return context
 
 
+@tracing.traced("render")
 def template_to_file(source, target, context):
     """
     Populate templated local_settings and place it in the tempdir to be
@@ -276,13 +999,205 @@ def template_to_file(source, target, context):
 
     with open(target, "w") as target_file:
         with open(source) as source_file:
-            if env.get('template_key') == '$':
-                text = DottedIdAllowedTemplate(source_file.read()).substitute(context)
-            else:
-                text = source_file.read() % context
+            text = compile_template(source_file.read())(context)
         target_file.write(text)
 
 
+def compile_template(text):
+    """
+    Compile template `text` into a function which renders it from a context
+    dictionary, according to `env.template_key` as per template_to_file().
+    """
+
+    if env.get('template_key') == '$':
+        return DottedIdAllowedTemplate(text).substitute
+
+    return lambda context: text % context
+
+
+def cached_template(templates, text):
+    """
+    Return the compiled template for `text` from the dictionary `templates`,
+    compiling and adding it if this is the first time it has been seen.
+    """
+
+    digest = hashlib.sha1(text).digest()
+    if digest not in templates:
+        templates[digest] = compile_template(text)
+
+    return templates[digest]
+
+
+@tracing.traced("render")
+def render_tree(source_dir, target_dir, context, non_template_exts=(),
+                pool_size=8):
+    """
+    Render every file under `source_dir` to the same relative path under
+    `target_dir`, using a pool of `pool_size` threads.
+
+    Files with an extension in `non_template_exts` are copied as-is. Each
+    distinct template is only compiled once, outputs whose content hasn't
+    changed are left untouched so that rsync can skip them, and files that
+    no longer exist in `source_dir` are removed from `target_dir`.
+
+    Returns the number of files that were written.
+    """
+
+    sources = []
+    for root, dirs, files in os.walk(source_dir):
+        relative_path = os.path.relpath(root, source_dir)
+
+        conf_dir = os.path.normpath(os.path.join(target_dir, relative_path))
+        if not os.path.exists(conf_dir):
+            os.makedirs(conf_dir)
+
+        for conf_file in files:
+            sources.append(os.path.normpath(os.path.join(relative_path, conf_file)))
+
+    templates = {}
+    templates_lock = threading.Lock()
+
+    def render(conf_file):
+        source = os.path.join(source_dir, conf_file)
+        target = os.path.join(target_dir, conf_file)
+
+        with open(source) as source_file:
+            text = source_file.read()
+
+        if os.path.splitext(conf_file)[1] not in non_template_exts:
+            with templates_lock:
+                template = cached_template(templates, text)
+            text = template(context)
+
+        if os.path.isfile(target):
+            with open(target) as target_file:
+                if hashlib.sha1(target_file.read()).digest() == \
+                        hashlib.sha1(text).digest():
+                    return False
+
+        with open(target, "w") as target_file:
+            target_file.write(text)
+        shutil.copymode(source, target)
+
+        return True
+
+    pool = ThreadPool(max(1, int(pool_size)))
+    try:
+        written = pool.map(render, sources)
+    finally:
+        pool.close()
+
+    # Remove anything left over from a previous render.
+    sources = set(sources)
+    for root, dirs, files in os.walk(target_dir):
+        for conf_file in files:
+            target = os.path.join(root, conf_file)
+            if os.path.relpath(target, target_dir) not in sources:
+                os.remove(target)
+
+    return sum(written)
+
+
+@tracing.traced("render")
+def render_archive(source, prefix, context, non_template_exts=()):
+    """
+    Render the members of tar.gz archive `source` below the directory
+    `prefix` into a new local tar.gz archive, with `prefix` stripped from
+    their names, and return its path. The archive is removed when Fabric
+    exits, because it is rendered once and then deployed to every host.
+
+    Both archives are streamed, so no directory tree is written to disk and
+    only one member is held in memory at a time. Members with an extension
+    in `non_template_exts` are passed through unchanged.
+    """
+
+    fd, target = tempfile.mkstemp(suffix=".tar.gz")
+    os.close(fd)
+    atexit.register(os.remove, target)
+
+    templates = {}
+    prefix = os.path.normpath(prefix) + "/"
+
+    source_archive = tarfile.open(source, "r|gz")
+    target_archive = tarfile.open(target, "w:gz")
+    try:
+        for member in source_archive:
+            name = os.path.normpath(member.name)
+            if not name.startswith(prefix):
+                continue
+
+            info = copy.copy(member)
+            info.name = name[len(prefix):]
+
+            if not member.isfile():
+                target_archive.addfile(info)
+                continue
+
+            fileobj = source_archive.extractfile(member)
+
+            if os.path.splitext(name)[1] in non_template_exts:
+                target_archive.addfile(info, fileobj)
+                continue
+
+            text = cached_template(templates, fileobj.read())(context)
+            info.size = len(text)
+            target_archive.addfile(info, StringIO(text))
+    finally:
+        target_archive.close()
+        source_archive.close()
+
+    return target
+
+
+def deploy_archive(archive, remote_dir, user=None, delete=False, exclude=()):
+    """
+    Unpack local tar.gz `archive` into `remote_dir` as `user`, or as the
+    connecting user if `user` is None.
+
+    The archive is unpacked into a remote staging directory and then synced
+    into place, so that like rsync_project() unchanged files are left alone
+    and, with `delete`, files that aren't in the archive are removed.
+    """
+
+    remote_archive = run("mktemp")
+    try:
+        put(archive, remote_archive, mode=0644)
+
+        rsync_opts = "-rlpt"
+        if delete:
+            rsync_opts += " --delete"
+        for pattern in exclude:
+            rsync_opts += " --exclude '%s'" % pattern
+
+        cmd = "staging=$(mktemp -d) && " \
+              "tar -C $staging -xzf %s && " \
+              "rsync %s $staging/ %s/; " \
+              "status=$?; rm -rf $staging; exit $status" \
+              % (remote_archive, rsync_opts, remote_dir.rstrip("/"))
+
+        if user:
+            sudo(cmd, user=user)
+        else:
+            run(cmd)
+    finally:
+        run("rm -f %s" % remote_archive)
+
+
+def file_checksum(filename):
+    """
+    SHA1 hex digest of a local file, read in chunks.
+    """
+
+    digest = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), ""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
 
 class DottedIdAllowedTemplate(Template):
     idpattern = r'[a-z][\._a-z0-9]*'
+
+
+tracing.instrument(sys.modules[__name__])